@@ -18,6 +18,7 @@ def scan_ip(comments):
     output_file = generate_output_filename(output_dir, ip, country)
     with open(output_file, "w") as out:
         out.write(f"IP is {ip} ({country}) via {comments['VPN_SERVICE_PROVIDER']}\n")
+        out.write(f"session {comments['SCANYWHERE_SESSION_ID']} (gluetun ip {comments['GLUETUN_IP']})\n")
 
 if __name__ == "__main__":
     print("hello")
@@ -29,6 +30,7 @@ if __name__ == "__main__":
         'VPN_SERVICE_PROVIDER': os.environ.get('VPN_SERVICE_PROVIDER', "undefined"),
         'VPN_TYPE': os.environ.get('VPN_TYPE', "undefined"),
         'GLUETUN_IP': os.environ.get('GLUETUN_IP', "undefined"),
+        'SCANYWHERE_SESSION_ID': os.environ.get('SCANYWHERE_SESSION_ID', "undefined"),
     }
 
     ip_utils.PREFERED_ADDR = socket.AF_INET
@@ -75,7 +75,8 @@ if __name__ == "__main__":
             output.write("\n".join([
                 os.environ.get('VPN_SERVICE_PROVIDER', "undefined"),
                 os.environ.get('VPN_TYPE', "undefined"),
-                os.environ.get('GLUETUN_IP', "undefined")
+                os.environ.get('GLUETUN_IP', "undefined"),
+                os.environ.get('SCANYWHERE_SESSION_ID', "undefined")
             ]))
         level = 0
         hostlist_file = HOSTLIST_FILE
@@ -3668,6 +3668,7 @@ if __name__ == '__main__':
         'VPN_SERVICE_PROVIDER': os.environ.get('VPN_SERVICE_PROVIDER', "undefined"),
         'VPN_TYPE': os.environ.get('VPN_TYPE', "undefined"),
         'GLUETUN_IP': os.environ.get('GLUETUN_IP', "undefined"),
+        'SCANYWHERE_SESSION_ID': os.environ.get('SCANYWHERE_SESSION_ID', "undefined"),
     }
 
     print("SCAN IPV4 start")
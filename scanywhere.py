@@ -11,14 +11,29 @@ import json
 import argparse
 import socket
 import itertools
-from contextlib import closing
-from utils.ec2_manager import EC2Manager
+import threading
+import concurrent.futures
+from contextlib import closing, contextmanager
+from utils.ec2_manager import EC2Manager, EC2Fleet, EC2LeasePool
+from utils.docker_events import ContainerEventWatcher, CONTAINER_LABEL
+from utils.gluetun_servers import get_server_index
+from utils.coverage_scheduler import CoverageScheduler, get_endpoint_id, parse_endpoint_id
+from utils.image_builder import build_image, build_images, UnknownImageError
+from utils.gluetun_readiness import GluetunReadinessDetector, GluetunFatalError, ConnectTimeouts, record_connect_time
+from utils.result_ingester import ResultIngester, write_run_metadata
+from utils.phase_timing import collect_phases, get_active_phases, get_active_outcomes, timed_phase, record_phase_times, add_phase_time
+from utils.warp_profiles import WarpProfilePool
+from utils.container_gc import archive_and_remove_container, collect_garbage
+from utils.job_queue import JobQueue, get_worker_id, is_remote, open_job_queue, serve_job_queue
+from utils.checkpoint import Checkpoint, CheckpointLockedError, get_checkpoint_path
 from utils.hideme import get_hideme_servers
 from utils.ip_utils import get_ip_info
 from utils.tor_utils import get_available_tor_countries
 
 PATH_CREDENTIALS = "credentials.json"
 GLUETUN_API_PORT = None #8000
+# seconds a container gets to shut down before it is killed
+STOP_TIMEOUT = 3
 
 # requests over tor socks proxy had difficulties with ipv6
 requests.packages.urllib3.util.connection.HAS_IPV6 = False
@@ -169,6 +184,17 @@ ENVIRONMENT__BASE_TOR = {
     "VPN_SERVICE_PROVIDER": "tor",
 }
 
+# max simultaneous connections per subscription (see comments above), missing providers are unlimited
+DEVICE_LIMITS = {
+    "nordvpn": 6,
+    "mullvad": 5,
+    "protonvpn": 10,
+    "hidemyass": 5,
+    "cyberghost": 7,
+    "ivpn": 7,
+    "hideme": 10,
+}
+
 
 HIDEME_TEMPLATE = """
 client
@@ -271,22 +297,116 @@ cdf5c6b3be5f9919854bb10182c86794
 </tls-crypt>
 """
 
-started_containers = list()
+device_semaphores = dict()
+device_semaphores_lock = threading.Lock()
+
+# ports handed out recently but maybe not yet bound by docker (parallel workers would race for them otherwise)
+reserved_ports = dict()
+reserved_ports_lock = threading.Lock()
+
+counter_lock = threading.Lock()
+
+container_events = None
+container_events_lock = threading.Lock()
+
+coverage_scheduler = None
+
+# set in main if results are ingested into the results database
+result_ingester = None
+
+# set in main if warp is used
+warp_profile_pool = None
+
+# set in main, connect timeouts adapted to the recorded time-to-ready
+connect_timeouts = None
+
+# random/iterative selection draws again if the selected endpoint is in failure backoff
+MAX_SELECTION_ATTEMPTS = 10
+
+# seconds between two polls of the job queue (coordinator and workers)
+JOB_POLL_INTERVAL = 5
+LEASE_RETRY_INTERVAL = 10
+
+# set in main, progress of the campaign (counter and iterations in flight)
+checkpoint = None
+
+# set in main, ec2 instances launched ahead of their iteration
+ec2_fleet = None
+
+# set in main, running ec2 instances reused by later iterations
+ec2_lease_pool = None
+
+def find_free_port(host="127.0.0.1", reservation_time=60):
+    with reserved_ports_lock:
+        now = time.time()
+        for port, reserved_at in list(reserved_ports.items()):
+            if now - reserved_at > reservation_time:
+                del reserved_ports[port]
+        while True:
+            with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+                s.bind((host, 0))
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                port = s.getsockname()[1]
+            if port not in reserved_ports:
+                reserved_ports[port] = now
+                return port
+
+def get_device_semaphore(provider):
+    limit = DEVICE_LIMITS.get(provider)
+    if not limit:
+        return None
+    with device_semaphores_lock:
+        return device_semaphores.setdefault(provider, threading.BoundedSemaphore(limit))
+
+def acquire_device_slot(provider):
+    semaphore = get_device_semaphore(provider)
+    if semaphore is None:
+        return None
+    if not semaphore.acquire(blocking=False):
+        logging.info(f"all {DEVICE_LIMITS[provider]} devices of {provider} in use, waiting for a free slot...")
+        semaphore.acquire()
+    return semaphore
+
+def release_device_slot(semaphore):
+    if semaphore is not None:
+        semaphore.release()
 
-def find_free_port(host="127.0.0.1"):
-    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-        s.bind((host, 0))
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        return s.getsockname()[1]
+@contextmanager
+def device_slot(provider):
+    semaphore = acquire_device_slot(provider)
+    try:
+        yield
+    finally:
+        release_device_slot(semaphore)
+
+def get_container_events(client):
+    global container_events
+    with container_events_lock:
+        if container_events is None:
+            container_events = ContainerEventWatcher(client)
+        return container_events
+
+def wait_for_container_exit(client, container_name, check_interval=60):
+    events = get_container_events(client)
+    while not events.wait(container_name, check_interval):
+        # safety net in case the event stream missed the exit
+        if not is_container_running(client, container_name):
+            break
+    return events.get_exit_code(container_name)
 
-def get_gluetun_ip_info(url="http://localhost:8000/v1/publicip/ip", sleeptime=2, ip_field="public_ip", country_field="country", maxwait=60*5):
-    return get_ip_info(url, sleeptime, ip_field, country_field, maxwait)
+def get_gluetun_ip_info(client, gluetun_name, api_port, abort_event=None, maxwait=60*5):
+    detector = GluetunReadinessDetector(client, gluetun_name, api_port, abort_event=abort_event, maxwait=maxwait)
+    return detector.wait()
 
-def build_container(client, tag):
-    logging.info(f"build {tag} container...")
-    client.images.build(path = f"docker/{tag}/", tag=tag)
+def build_container(client, tag, force=False):
+    return build_image(client, f"docker/{tag}/", tag, force)
+
+@timed_phase("build_container")
+def build_containers(client, tags, force=False):
+    return build_images(client, {tag: f"docker/{tag}/" for tag in tags}, force)
     
-def run_tor_container(client, environment, network, image_tag="gluetor"):
+@timed_phase("run_tor_container")
+def run_tor_container(client, environment, started_containers, network, image_tag="gluetor"):
     socks_port = GLUETUN_API_PORT or find_free_port()
     logging.info(f"start tor (socks port {socks_port})")
     cur_dir = pathlib.Path(".")
@@ -299,21 +419,21 @@ def run_tor_container(client, environment, network, image_tag="gluetor"):
         ports = {f"9050/tcp": ('127.0.0.1', socks_port)}, 
         #sysctls = {"net.ipv6.conf.all.disable_ipv6": "0"},
         environment = environment | {"ExitCountry" : environment.get('SERVER_COUNTRIES')},
+        labels = [CONTAINER_LABEL],
         detach = True,
         remove = True
     )
         
     started_containers.append(container.name)
-    time.sleep(5)
-    assert is_container_running(client, container.name)
+    exited = get_container_events(client).get_event(container.name)
     #ip, country = get_ip_info(f"https://ipinfo.io/json", ip_field="ip", country_field="country", proxies=dict(http=f'socks5://127.0.0.1:{socks_port}', https=f'socks5://127.0.0.1:{socks_port}'))
-    ip, country = get_ip_info(f"https://wtfismyip.com/json", proxies=dict(http=f'socks5h://127.0.0.1:{socks_port}', https=f'socks5h://127.0.0.1:{socks_port}'))
+    ip, country = get_ip_info(f"https://wtfismyip.com/json", proxies=dict(http=f'socks5h://127.0.0.1:{socks_port}', https=f'socks5h://127.0.0.1:{socks_port}'), abort_event=exited)
     
     environment['TOR_IP'] = ip
     logging.info(f"tor container[{container.name}] connected with {country} ({ip})")
     return container.name
 
-def run_gluetun(client, environment, api_port=8000, network="", image="qmcgaw/gluetun:latest"):
+def run_gluetun(client, environment, started_containers, api_port=8000, network="", image="qmcgaw/gluetun:latest"):
     cur_dir = pathlib.Path(".")
     container = client.containers.run(
         image = image,
@@ -325,39 +445,81 @@ def run_gluetun(client, environment, api_port=8000, network="", image="qmcgaw/gl
         ports = {f"{api_port}/tcp": ('127.0.0.1', api_port)}, #if not network else {},
         sysctls = {"net.ipv6.conf.all.disable_ipv6": "0"}, #if network != "host" else {},
         environment = environment | {"HTTP_CONTROL_SERVER_ADDRESS" : f":{api_port}"},
+        labels = [CONTAINER_LABEL],
         detach = True,
         remove = True
     )
     started_containers.append(container.name)
     return container.name
 
-def run_gluetun_extended(client, environment, container_list, network="", image="qmcgaw/gluetun:latest"):
+@timed_phase("run_gluetun_extended")
+def run_gluetun_extended(client, environment, started_containers, network="", image="qmcgaw/gluetun:latest"):
     api_port = GLUETUN_API_PORT or find_free_port()
     logging.info(f"start gluetun (api port {api_port})")
-    gluetun_name = run_gluetun(client, environment, api_port, network, image)
-    time.sleep(5)
-    assert is_container_running(client, gluetun_name)
-    ip, country = get_gluetun_ip_info(f"http://localhost:{api_port}/v1/publicip/ip")
+    time_start = time.time()
+    record = {
+        "time": time_start,
+        "provider": environment.get('SCANYWHERE_PROVIDER', environment.get('VPN_SERVICE_PROVIDER')),
+        "vpn_type": environment.get('VPN_TYPE'),
+        "country": environment.get('SERVER_COUNTRIES'),
+        "region": environment.get('SERVER_REGIONS', environment.get('EC2_REGION')),
+        "image": image,
+        "outcome": "ready",
+    }
+    record["timeout"] = connect_timeouts.get_timeout(record) if connect_timeouts else 60*5
+    try:
+        gluetun_name = run_gluetun(client, environment, started_containers, api_port, network, image)
+        # stop waiting for an ip as soon as the container dies
+        exited = get_container_events(client).get_event(gluetun_name)
+        ip, country = get_gluetun_ip_info(client, gluetun_name, api_port, abort_event=exited, maxwait=record["timeout"])
+    except TimeoutError:
+        record["outcome"] = "timeout"
+        raise
+    except (AssertionError, InterruptedError):
+        record["outcome"] = "exited"
+        raise
+    except GluetunFatalError as e:
+        record["outcome"] = "fatal"
+        record["reason"] = str(e)
+        raise
+    except:
+        record["outcome"] = "error"
+        raise
+    finally:
+        record["seconds"] = time.time() - time_start
+        record_connect_time(record)
+        if connect_timeouts:
+            connect_timeouts.add(record)
     environment['GLUETUN_IP'] = ip
-    logging.info(f"gluetun[{gluetun_name}] connected with {country} ({ip})")
+    logging.info(f"gluetun[{gluetun_name}] connected with {country} ({ip}) after {record['seconds']:.1f}s")
+    if environment.get('SCANYWHERE_EC2_SETUP'):
+        logging.info(f"ec2 region {environment.get('EC2_REGION')}: {environment['SCANYWHERE_EC2_SETUP']}, handshake {record['seconds']:.1f}s")
     return gluetun_name
 
-def warponize_container(client, gluetun_name, network=""):
+def register_warp_profile(client, gluetun_name, image="qmcgaw/gluetun:latest"):
+    # register a new warp account in a throwaway container, returns the generated wireguard profile
+    # runs in the network of a connected gluetun container, cloudflare does not see the host address
+    cur_dir = pathlib.Path(".")
+    output = client.containers.run(
+        image = image,
+        network = f"container:{gluetun_name}",
+        entrypoint = "sh",
+        command = ["-c", "/gluetun/wgcf register --accept-tos --config /tmp/wgcf-account.toml > /dev/null && "
+                         "/gluetun/wgcf generate --profile /tmp/wgcf-account.toml --config /tmp/wgcf-account.toml > /dev/null && "
+                         "cat /tmp/wgcf-account.toml"],
+        volumes = [f"{cur_dir.absolute()}/docker/gluetun:/gluetun"],
+        labels = [CONTAINER_LABEL],
+        remove = True
+    )
+    return output.decode()
+
+@timed_phase("warponize_container")
+def warponize_container(client, gluetun_name, started_containers, network=""):
     logging.info(f"warporize gluetun container [{gluetun_name}]")
     container = client.containers.get(gluetun_name)
-    container.exec_run("/gluetun/wgcf register --accept-tos --config /tmp/wgcf-account.toml")
-    container.exec_run("/gluetun/wgcf generate --profile /tmp/wgcf-account.toml --config /tmp/wgcf-account.toml")
-    config = container.exec_run("cat /tmp/wgcf-account.toml").output
-    #logging.info(f"got config...{config}")
-    params = dict()
-    for line in config.decode().splitlines():
-        if "=" in line:
-            key, value = [x.strip() for x in line.split("=", 1)]
-            if key in params:
-                params[key] = f"{params[key]},{value}"
-            else:
-                params[key] = value
-                
+    # released when the first layer gluetun container is stopped
+    params = warp_profile_pool.acquire(gluetun_name, via=gluetun_name)
+
     gateway_ip = container.attrs.get("NetworkSettings", {}).get("IPAddress") or container.attrs.get("NetworkSettings", {}).get("Networks", {}).get(network).get("IPAddress")
     environment = ENVIRONMENT_BASE | {
         "VPN_SERVICE_PROVIDER": "custom",
@@ -368,26 +530,29 @@ def warponize_container(client, gluetun_name, network=""):
         "VPN_ENDPOINT_IP":"162.159.192.1", #cloudflare ip
         "VPN_ENDPOINT_PORT":"2408",
         "WIREGUARD_MTU": params["MTU"],
-        "WARP_GATEWAY_IP":gateway_ip
+        "WARP_GATEWAY_IP":gateway_ip,
+        "SCANYWHERE_PROVIDER": "warp"
     }
     #logging.info(f"run warporizer...{environment}")
     #network = f"container:{gluetun_name}"#
-    gluetun_name = run_gluetun_extended(client, environment, network, image="gluetun-warp")
+    gluetun_name = run_gluetun_extended(client, environment, started_containers, image="gluetun-warp")
     return gluetun_name, environment['GLUETUN_IP']
 
-def run_image(client, gluetun_name, environment, image_tag, remove = False):
+def run_image(client, gluetun_name, environment, image_tag, started_containers, remove = False, results_dir=None):
     cur_dir = pathlib.Path(".")
+    results_dir = results_dir or f"docker/{image_tag}/results"
     container = client.containers.run(
         image = f"{image_tag}:latest",
         network = f"container:{gluetun_name}",
         volumes = [f"{cur_dir.absolute()}/docker/{image_tag}/resources:/{image_tag}/resources:ro",
-                   f"{cur_dir.absolute()}/docker/{image_tag}/results:/{image_tag}/results"],
+                   f"{cur_dir.absolute()}/{results_dir}:/{image_tag}/results"],
         sysctls = {
             "net.ipv6.conf.all.disable_ipv6": "0"
         },
         environment = environment | {
             "PYTHONUNBUFFERED": "1"
         },
+        labels = [CONTAINER_LABEL],
         detach = True,
         remove = remove
     )
@@ -404,16 +569,37 @@ def get_container_status(client, container_name):
 def is_container_running(client, container_name):
     return get_container_status(client, container_name) in ['created', "running", "restarting"]
 
-def stop_container(container_name):
+def stop_container(client, container_name, timeout=STOP_TIMEOUT):
     try:
         container = client.containers.get(container_name)
-        container.stop()
     except:
-        pass
+        # already removed
+        return
+    try:
+        container.stop(timeout=timeout)
+    except:
+        logging.warning(f"stopping container[{container_name}] failed, kill it")
+        try:
+            container.kill()
+        except:
+            pass
+
+def forget_container(client, container_name):
+    get_container_events(client).forget(container_name)
+    if warp_profile_pool:
+        warp_profile_pool.release(container_name)
 
-def stop_all_started_containers():
-    for c in reversed(started_containers):
-        stop_container(c)
+@timed_phase("stop_all_started_containers")
+def stop_all_started_containers(client, started_containers):
+    # stop in parallel, so teardown takes one grace period instead of one per container
+    containers = list(reversed(started_containers))
+    if containers:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(containers)) as executor:
+            executor.map(lambda c: stop_container(client, c), containers)
+    for c in containers:
+        forget_container(client, c)
+    # the registry of this session is empty again
+    started_containers.clear()
 
 def prune_docker_images(client, image_label):
     try:
@@ -421,96 +607,183 @@ def prune_docker_images(client, image_label):
     except:
         pass
     
-def run_measurement(client, gluetun_name, gluetun_environment, target_image):
+def get_selected_location(gluetun_environment):
+    return {
+        "country": gluetun_environment.get('SERVER_COUNTRIES'),
+        "region": gluetun_environment.get('SERVER_REGIONS') or gluetun_environment.get('EC2_REGION'),
+        "endpoint": gluetun_environment.get('SCANYWHERE_ENDPOINT'),
+    }
+
+def get_run_metadata(run_id, target_image, gluetun_environment):
+    # measurements over the warp (second) layer are not stored under the location selected for the first layer
+    layer = gluetun_environment.get('SCANYWHERE_LAYER', "vpn")
+    location = get_selected_location(gluetun_environment)
+    first_hop = None
+    if layer == "warp":
+        first_hop = location | {"provider": gluetun_environment.get('SCANYWHERE_FIRST_HOP_PROVIDER')}
+        location = dict.fromkeys(location)
+    return {
+        "run_id": run_id,
+        "session_id": gluetun_environment.get('SCANYWHERE_SESSION_ID'),
+        "image": target_image,
+        "container": None,
+        "provider": gluetun_environment.get('SCANYWHERE_PROVIDER') or gluetun_environment.get('VPN_SERVICE_PROVIDER'),
+        "vpn_type": gluetun_environment.get('VPN_TYPE'),
+        "country": location["country"],
+        "region": location["region"],
+        "endpoint": location["endpoint"],
+        "layer": layer,
+        "first_hop": first_hop,
+        "gluetun_ip": gluetun_environment.get('GLUETUN_IP') or gluetun_environment.get('TOR_IP'),
+        "started": time.time(),
+        "finished": None,
+        "exit_code": None,
+    }
+
+def prepare_run_dir(target_image, gluetun_environment):
+    # one results directory per measurement, its run.json carries what the orchestrator knows about the tunnel
+    run_id = uuid.uuid4().hex
+    run_dir = pathlib.Path("docker") / target_image / "results" / run_id
+    run_dir.mkdir(parents=True)
+    metadata = get_run_metadata(run_id, target_image, gluetun_environment)
+    write_run_metadata(run_dir, metadata)
+    return run_dir, metadata
+
+def launch_measurement(client, gluetun_name, gluetun_environment, target_image, started_containers):
     try:
-        measurement_name = run_image(client, gluetun_name, gluetun_environment, target_image)
-        logging.info(f"measurement launched: image[{target_image}] within container[{measurement_name}]")
-        while(is_container_running(client, measurement_name)):
-            time.sleep(1)
-        logging.info(f"measurement finished: image[{target_image}] within container[{measurement_name}]")
+        measurement = {"image": target_image, "name": None, "run_dir": None, "metadata": None}
+        if result_ingester:
+            measurement["run_dir"], measurement["metadata"] = prepare_run_dir(target_image, gluetun_environment)
+        measurement["name"] = run_image(client, gluetun_name, gluetun_environment, target_image, started_containers, results_dir=measurement["run_dir"])
+        save_checkpoint()
+        logging.info(f"measurement launched: image[{target_image}] within container[{measurement['name']}]")
+        return measurement
+    except:
+        logging.error("error running measurement...")
+        return None
+
+def wait_for_measurement(client, measurement):
+    if not measurement:
+        return None
+    try:
+        exit_code = wait_for_container_exit(client, measurement["name"])
+        logging.info(f"measurement finished: image[{measurement['image']}] within container[{measurement['name']}] (exit code {exit_code})")
+        # keep the logs next to the results instead of an exited container per measurement
+        archive_and_remove_container(client, measurement["name"], measurement["image"], measurement["run_dir"])
+        if measurement["run_dir"]:
+            write_run_metadata(measurement["run_dir"], measurement["metadata"] | {"container": measurement["name"], "finished": time.time(), "exit_code": exit_code})
+            result_ingester.submit(measurement["run_dir"])
+        return exit_code
     except:
         logging.error("error running measurement...")
+        return None
+
+@timed_phase("run_measurement")
+def run_measurement(client, gluetun_name, gluetun_environment, target_image, started_containers):
+    return wait_for_measurement(client, launch_measurement(client, gluetun_name, gluetun_environment, target_image, started_containers))
+
+@timed_phase("run_measurement")
+def run_measurements_concurrently(client, gluetun_name, gluetun_environment, target_images, started_containers):
+    measurements = [launch_measurement(client, gluetun_name, gluetun_environment, image, started_containers) for image in target_images]
+    return [wait_for_measurement(client, m) for m in measurements]
 
-def start_containers_tor(client, environment, target_image, network=""):
+def run_measurements(client, gluetun_name, gluetun_environment, target_images, started_containers, concurrent=False):
+    # all images share the network namespace (and public ip) of the given vpn container
+    if concurrent:
+        return run_measurements_concurrently(client, gluetun_name, gluetun_environment, target_images, started_containers)
+    return [run_measurement(client, gluetun_name, gluetun_environment, image, started_containers) for image in target_images]
+
+@contextmanager
+def handle_container_errors(container_type, show_unknown_traceback=True):
     try:
-        tor_name = run_tor_container(client, environment, network)
-        run_measurement(client, tor_name, environment, target_image)
+        yield
     except TimeoutError:
-        logging.error("tor container did not get an ip address..")
-        pass
-    except AssertionError:
-        logging.error("tor container was not properly started...?")
+        logging.error(f"{container_type} did not get an ip address..")
+    except (AssertionError, InterruptedError):
+        logging.error(f"{container_type} was not properly started...?")
         import traceback
         print(traceback.format_exc())
-        pass
+    except GluetunFatalError as e:
+        logging.error(f"{container_type} failed with unrecoverable error: {e}")
+        # provider-wide (e.g. AUTH_FAILED), the iteration records it as "fatal" instead of an endpoint failure
+        raise
     except:
         logging.error("unknown error occured...")
-        import traceback
-        print(traceback.format_exc())
-        pass
+        if show_unknown_traceback:
+            import traceback
+            print(traceback.format_exc())
+
+def connect_containers_tor(client, environment, started_containers, network=""):
+    with handle_container_errors("tor container"):
+        return run_tor_container(client, environment, started_containers, network)
+    return None
+
+def connect_containers_gluetun(client, gluetun_environment, started_containers, network=""):
+    with handle_container_errors("gluetun", show_unknown_traceback=False):
+        return run_gluetun_extended(client, gluetun_environment, started_containers)
+    return None
+
+def measure_containers_gluetun(client, gluetun_name, gluetun_environment, target_images, started_containers, network="", warp_mode="off", concurrent=False):
+    # returns True if every measurement exited successfully
+    exit_codes = []
+    with handle_container_errors("gluetun", show_unknown_traceback=False):
+        pending_warp = None
+        if warp_mode == "dual":
+            # the warp hop only needs the first layer gluetun, so build it while the first measurement runs
+            pending_warp = run_async(warponize_container, client, gluetun_name, started_containers, network)
+        if warp_mode in ["off", "dual"]:
+            # run measurement in normal (first layer) vpn
+            exit_codes.extend(run_measurements(client, gluetun_name, gluetun_environment, target_images, started_containers, concurrent))
+        if warp_mode in ["warp", "dual"]:
+            if pending_warp:
+                warp_name, warp_ip = pending_warp.result()
+            else:
+                warp_name, warp_ip = warponize_container(client, gluetun_name, started_containers, network)
+            warp_environment = gluetun_environment | {
+                'GLUETUN_IP': warp_ip,
+                'VPN_SERVICE_PROVIDER': "warp",
+                'VPN_TYPE': "wireguard",
+                'SCANYWHERE_PROVIDER': "warp",
+                # the selected location and endpoint belong to the first layer
+                'SCANYWHERE_LAYER': "warp",
+                'SCANYWHERE_FIRST_HOP_PROVIDER': gluetun_environment.get('SCANYWHERE_PROVIDER'),
+            }
+            # run measurement in warp (second layer) vpn
+            exit_codes.extend(run_measurements(client, warp_name, warp_environment, target_images, started_containers, concurrent))
+        return bool(exit_codes) and all(code == 0 for code in exit_codes)
+    return False
 
-def start_containers_gluetun(client, environment, target_image, network="", warp_mode="off"):
+def get_gluetun_environment(environment):
     gluetun_environment = environment.copy()
+    # keep the original provider for bookkeeping, gluetun only knows ec2/hideme as custom
+    gluetun_environment['SCANYWHERE_PROVIDER'] = gluetun_environment.get('VPN_SERVICE_PROVIDER')
     if gluetun_environment.get('VPN_SERVICE_PROVIDER') in ['ec2']:
         gluetun_environment['VPN_SERVICE_PROVIDER'] = 'custom'
     elif gluetun_environment.get('VPN_SERVICE_PROVIDER') in ['hideme']:
         gluetun_environment['VPN_SERVICE_PROVIDER'] = 'custom'
-    try:
-        gluetun_name = run_gluetun_extended(client, gluetun_environment, network)
-        if warp_mode in ["off", "dual"]:
-            # run measurement in normal (first layer) vpn
-            run_measurement(client, gluetun_name, gluetun_environment, target_image)
-        if warp_mode in ["on", "dual"]:
-            gluetun_name, warp_ip = warponize_container(client, gluetun_name, network)
-            gluetun_environment['GLUETUN_IP'] = warp_ip
-            gluetun_environment['VPN_SERVICE_PROVIDER'] = "warp"
-            gluetun_environment['VPN_TYPE'] = "wireguard"
-            # run measurement in warp (second layer) vpn
-            run_measurement(client, gluetun_name, gluetun_environment, target_image)
-    except TimeoutError:
-        logging.error("gluetun did not get an ip address..")
-        pass
-    except AssertionError:
-        logging.error("gluetun was not properly started...?")
-        import traceback
-        print(traceback.format_exc())
-        pass
-    except:
-        logging.error("unknown error occured...")
-        #import traceback
-        #print(traceback.format_exc())
-        pass
+    return gluetun_environment
 
-def start_containers(client, environment, target_image, network="", warp_mode="off"):
-    # check if image is present:
-    try:
-        client.images.get(target_image)
-    except:
-        logging.error(f"unknown image {target_image}")
-        exit(-1)
-    
+def connect_containers(client, environment, started_containers, network=""):
+    # returns the name of the connected vpn container (or None) and the environment for the measurement
+    # all measurements over this connection share its session id
+    environment['SCANYWHERE_SESSION_ID'] = uuid.uuid4().hex
     if environment.get('VPN_SERVICE_PROVIDER') in ['tor']:
-        start_containers_tor(client, environment, target_image, network)
-    else:
-        start_containers_gluetun(client, environment, target_image, network, warp_mode)
+        return connect_containers_tor(client, environment, started_containers, network), environment
+    gluetun_environment = get_gluetun_environment(environment)
+    return connect_containers_gluetun(client, gluetun_environment, started_containers, network), gluetun_environment
 
-    stop_all_started_containers()
+def measure_containers(client, gluetun_name, gluetun_environment, target_images, started_containers, network="", warp_mode="off", concurrent=False):
+    if gluetun_environment.get('VPN_SERVICE_PROVIDER') in ['tor']:
+        return all(code == 0 for code in run_measurements(client, gluetun_name, gluetun_environment, target_images, started_containers, concurrent))
+    return measure_containers_gluetun(client, gluetun_name, gluetun_environment, target_images, started_containers, network, warp_mode, concurrent)
 
-def read_gluetun_servers(json_path="docker/gluetun/servers.json"):
-  parsed = None
-  while True:
+def check_image(client, target_image):
+    # raises instead of exit(), which would only end the calling worker thread
     try:
-        with open(json_path) as file:
-            content = file.read()
-            parsed = json.loads(content)
-            if parsed:
-                return parsed
-            else:
-                logging.error("no content read from servers.json")
+        client.images.get(target_image)
     except:
-        logging.error("exception parsing gluetun servers.json")
-        time.sleep(5)
-        
+        raise UnknownImageError(f"unknown image {target_image}")
+
 def select_element(elements, counter, selection_strategy, normalize):
     if normalize:
         elements = list(dict.fromkeys(elements))
@@ -518,113 +791,656 @@ def select_element(elements, counter, selection_strategy, normalize):
         return elements[counter % len(elements)]
     return random.choice(elements)
 
-def prepare_environment(counter, service, countries, regions, server_selection, normalize):
+def filter_endpoints(provider_index, vpn_type, countries=None, regions=None):
+    endpoints_by_country = provider_index["endpoints_by_country"].get(vpn_type, dict())
+    if countries or regions:
+        endpoints_by_country = {c: [e for e in endpoints if not regions or e['region'] in regions] for c, endpoints in endpoints_by_country.items() if not countries or c in countries}
+        endpoints_by_country = {c: endpoints for c, endpoints in endpoints_by_country.items() if endpoints}
+    if not endpoints_by_country:
+        raise ValueError(f"no {vpn_type} endpoint matches countries {countries} and regions {regions}")
+    return endpoints_by_country
+
+def select_endpoint(provider_index, vpn_type, counter, selection_strategy, normalize, countries=None, regions=None):
+    endpoints_by_country = filter_endpoints(provider_index, vpn_type, countries, regions)
+    if normalize:
+        # pick the country first, so popular countries are not overrepresented
+        country = select_element(list(endpoints_by_country), counter, selection_strategy, False)
+        return select_element(endpoints_by_country[country], counter // len(endpoints_by_country), selection_strategy, False)
+    if countries or regions:
+        endpoints = [e for endpoints in endpoints_by_country.values() for e in endpoints]
+    else:
+        endpoints = provider_index["endpoints"][vpn_type]
+    return select_element(endpoints, counter, selection_strategy, False)
+
+def get_endpoint_environment(endpoint):
+    environment = {'SERVER_COUNTRIES' : endpoint['country'], 'VPN_ENDPOINT_IP' : endpoint['ip']}
+    if endpoint.get('region'):
+        environment['SERVER_REGIONS'] = endpoint['region']
+    if endpoint.get('hostname'):
+        environment['SERVER_HOSTNAMES'] = endpoint['hostname']
+    return environment
+
+def select_least_covered(provider, candidates):
+    return coverage_scheduler.select(provider, candidates)
+
+def record_outcome(environment, success, reason=None):
+    if coverage_scheduler is None or 'SCANYWHERE_ENDPOINT' not in environment:
+        return
+    coverage_scheduler.record(environment['VPN_SERVICE_PROVIDER'], parse_endpoint_id(environment['SCANYWHERE_ENDPOINT']), success, reason)
+
+def get_ec2_regions(regions):
+    return regions.split(',') if regions else EC2Manager.get_available_regions()
+
+def get_selectable_ec2_regions(regions):
+    # regions with a reusable instance first, with a fleet only regions whose instance is already running (waits for the first one unless one can be reused)
+    regions = get_ec2_regions(regions)
+    idle = ec2_lease_pool.get_idle_regions(regions) if ec2_lease_pool else []
+    if ec2_fleet is None:
+        return idle or regions
+    return list(dict.fromkeys(idle + ec2_fleet.get_ready_regions(regions, wait=not idle))) or regions
+
+def get_tor_countries(countries):
+    return countries.split(',') if countries else get_available_tor_countries('docker/gluetor/resources/relay_details.json')
+
+def get_coverage_candidates(service, countries, regions, selection_mode="location"):
+    environment = vpn_services[service]
+    if service == 'ec2':
+        return [{'region': r} for r in dict.fromkeys(get_selectable_ec2_regions(regions))]
+    if service == 'tor':
+        return [{'country': c} for c in dict.fromkeys(get_tor_countries(countries))]
+    provider_index = get_server_index().get_provider(environment["VPN_SERVICE_PROVIDER"])
+    country_list = countries.split(",") if countries else None
+    region_list = regions.split(",") if regions else None
+    if selection_mode == "endpoint":
+        endpoints_by_country = filter_endpoints(provider_index, environment["VPN_TYPE"], country_list, region_list)
+        return [e for endpoints in endpoints_by_country.values() for e in endpoints]
+    # only existing country/region combinations are candidates
+    return [{'country': c, 'region': r} for c, locations in provider_index["locations"].items() for r in locations
+            if (not country_list or c in country_list) and (not region_list or r in region_list)]
+
+def prepare_environment(counter, service, countries, regions, server_selection, normalize, selection_mode="location"):
     environment = vpn_services[service].copy()
+    environment['SCANYWHERE_SERVICE'] = service
+    provider = environment["VPN_SERVICE_PROVIDER"]
+    if server_selection == "coverage":
+        endpoint = select_least_covered(provider, get_coverage_candidates(service, countries, regions, selection_mode))
     if service == 'ec2':
-        ec2_regions = regions.split(',') if regions else EC2Manager.get_available_regions()
-        environment |= {'EC2_REGION' : select_element(ec2_regions, counter, server_selection, normalize)}
-        return environment
+        if server_selection != "coverage":
+            endpoint = {'region': select_element(get_selectable_ec2_regions(regions), counter, server_selection, normalize)}
+        environment |= {'EC2_REGION' : endpoint['region']}
     elif service == 'tor':
-        tor_countries = countries.split(',') if countries else get_available_tor_countries('docker/gluetor/resources/relay_details.json')
-        environment |= {'SERVER_COUNTRIES' : select_element(tor_countries, counter, server_selection, normalize)}
-        return environment
-        
-    service = environment["VPN_SERVICE_PROVIDER"]
-    gluetun_servers = read_gluetun_servers()
-    countries = countries.split(",") if countries else [d.get('country') for d in gluetun_servers[service]['servers']]
-    regions = regions.split(",") if regions else [d.get('region') for d in gluetun_servers[service]['servers']]
-    environment |= {'SERVER_COUNTRIES' : select_element(countries, counter, server_selection, normalize)}
-    environment |= {'SERVER_REGIONS' : select_element(regions, counter, server_selection, normalize)}
+        if server_selection != "coverage":
+            endpoint = {'country': select_element(get_tor_countries(countries), counter, server_selection, normalize)}
+        environment |= {'SERVER_COUNTRIES' : endpoint['country']}
+    elif selection_mode == "endpoint":
+        # pin a concrete server entry (and one of its ips), so country/region always match
+        if server_selection != "coverage":
+            provider_index = get_server_index().get_provider(provider)
+            country_list = countries.split(",") if countries else None
+            region_list = regions.split(",") if regions else None
+            endpoint = select_endpoint(provider_index, environment["VPN_TYPE"], counter, server_selection, normalize, country_list, region_list)
+        environment |= get_endpoint_environment(endpoint)
+    elif server_selection == "coverage":
+        environment |= {'SERVER_COUNTRIES' : endpoint['country']}
+        if endpoint['region']:
+            environment |= {'SERVER_REGIONS' : endpoint['region']}
+    else:
+        provider_index = get_server_index().get_provider(provider)
+        # indexed lists are already normalized, only user provided lists need it
+        normalized = "_normalized" if normalize else ""
+        country_list = countries.split(",") if countries else provider_index[f"countries{normalized}"]
+        region_list = regions.split(",") if regions else provider_index[f"regions{normalized}"]
+        endpoint = {
+            'country': select_element(country_list, counter, server_selection, normalize and bool(countries)),
+            'region': select_element(region_list, counter, server_selection, normalize and bool(regions)),
+        }
+        environment |= {'SERVER_COUNTRIES' : endpoint['country']}
+        environment |= {'SERVER_REGIONS' : endpoint['region']}
+    # identifies the selected endpoint for the coverage bookkeeping
+    environment['SCANYWHERE_ENDPOINT'] = get_endpoint_id(endpoint)
     return environment
-            
 
-if __name__ == '__main__':
-    vpn_services = {
-        'nord_open' : ENVIRONMENT_NORD_OPENVPN,
-        'nord_wg' : ENVIRONMENT_NORD_WIREGUARD,
-        'mullvad_open' : ENVIRONMENT_MULLVAD_OPENVPN,
-        'mullvad_wg' : ENVIRONMENT_MULLVAD_WIREGUARD,
-        'surfshark_open' : ENVIRONMENT_SURFSHARK_OPENVPN,
-        'surfshark_wg' : ENVIRONMENT_SURFSHARK_WIREGUARD,
-        'proton_open' : ENVIRONMENT_PROTONVPN_OPENVPN,
-        'pia_open' : ENVIRONMENT_PIA_OPENVPN,
-        'hma_open' : ENVIRONMENT_HIDEMYASS_OPENVPN,
-        'cyberghost_open' : ENVIRONMENT_CYBERGHOST_OPENVPN,
-        'ivpn_open' : ENVIRONMENT_IVPN_OPENVPN,
-        'ivpn_wg' : ENVIRONMENT_IVPN_WG,
-        'hideme_open': ENVIRONMENT_HIDEME_OPENVPN,
-        'ec2' : ENVIRONMENT_BASE_EC2,
-        'surfshark_open_india' : ENVIRONMENT_SURFSHARK_OPENVPN | {"SERVER_COUNTRIES" : "India"},
-        'proton_open_india' : ENVIRONMENT_PROTONVPN_OPENVPN | {"SERVER_COUNTRIES" : "India"},
-        'hma_missing' : ENVIRONMENT_HIDEMYASS_OPENVPN | {"SERVER_COUNTRIES" : "Russia, Belarus, Faroe Islands, Antiguaand Barbuda, Bermuda, Dominican Republic, Jordan, Kuwait, Oman, Maldives, Sudan, Tanzania, Namibia"},
-        'surfshark_germany' : ENVIRONMENT_SURFSHARK_OPENVPN | {"SERVER_COUNTRIES" : "Germany"},
-        'warp_wg': ENVIRONMENT_BASE_WARP,
-        'tor': ENVIRONMENT__BASE_TOR,
-    }
+def is_backed_off(environment):
+    if coverage_scheduler is None or 'SCANYWHERE_ENDPOINT' not in environment:
+        return False
+    return coverage_scheduler.is_backed_off(environment['VPN_SERVICE_PROVIDER'], parse_endpoint_id(environment['SCANYWHERE_ENDPOINT']))
+
+def has_free_device_slot(provider):
+    semaphore = get_device_semaphore(provider)
+    if semaphore is None:
+        return True
+    if semaphore.acquire(blocking=False):
+        semaphore.release()
+        return True
+    return False
+
+def get_expected_connect_time(service):
+    median = connect_timeouts.get_median({'provider': vpn_services[service]['VPN_SERVICE_PROVIDER']}) if connect_timeouts else None
+    return median if median is not None else 60
+
+def select_service(counter, args):
+    # returns the service to use and the counter for the endpoint selection within this service
+    services = args.vpn_service
+    if len(services) == 1:
+        return services[0], counter
+    if args.server_selection == "iterative":
+        # round robin, every service iterates over its own endpoints
+        return services[counter % len(services)], counter // len(services)
+    # services without a free device slot would block the worker
+    free = [s for s in services if has_free_device_slot(vpn_services[s]['VPN_SERVICE_PROVIDER'])] or services
+    if args.server_selection == "coverage":
+        # the service reaching the least covered country (over all services), then the one connecting faster
+        return min(free, key=lambda s: (
+            coverage_scheduler.get_least_covered_count(vpn_services[s]['VPN_SERVICE_PROVIDER'], get_coverage_candidates(s, args.countries, args.regions, args.selection_mode)),
+            get_expected_connect_time(s),
+            random.random())), counter
+    return random.choice(free), counter
+
+def select_environment(counter, args):
+    # the coverage selection skips endpoints in failure backoff by itself
+    for attempt in range(MAX_SELECTION_ATTEMPTS):
+        service, service_counter = select_service(counter + attempt, args)
+        environment = prepare_environment(service_counter, service, args.countries, args.regions, args.server_selection, not args.disable_normalization, args.selection_mode)
+        if args.server_selection == "coverage" or not is_backed_off(environment):
+            break
+        logging.info(f"endpoint {environment['SCANYWHERE_ENDPOINT']} failed repeatedly and is backed off, select another one")
+    return environment
+
+def prepare_iteration(counter, args, environment=None):
+    # environment is given if the endpoint was selected by the coordinator
+    environment = environment or select_environment(counter, args)
+    try:
+        tmp_path = prepare_connection(environment, args)
+    except:
+        record_outcome(environment, False, "prepare")
+        raise
+    return environment, tmp_path
+
+@timed_phase("prepare_connection")
+def prepare_connection(environment, args):
+    tmp_path = None
+    if environment['SCANYWHERE_SERVICE'] == 'ec2':
+        instance = ec2_lease_pool.acquire(environment.get('EC2_REGION')) if ec2_lease_pool else None
+        reused = instance is not None
+        if not reused:
+            instance = ec2_fleet.take(environment.get('EC2_REGION')) if ec2_fleet else None
+            if instance:
+                ec2_manager, client_config_dict = instance
+            else:
+                ec2_manager = EC2Manager(region=environment.get('EC2_REGION'))
+                client_config_dict = ec2_manager.start_instance_wg()
+            # time to a listening server (also of prelaunched instances), the handshake is part of run_gluetun_extended
+            setup_phases = ec2_manager.get_setup_phases()
+            for phase, seconds in setup_phases.items():
+                add_phase_time(phase, seconds)
+            environment['SCANYWHERE_EC2_SETUP'] = ", ".join(f"{phase[4:]} {seconds:.1f}s" for phase, seconds in setup_phases.items())
+        else:
+            ec2_manager, client_config_dict = instance
+        environment |= client_config_dict
+        if ec2_lease_pool and not reused:
+            # only leased once the environment is complete, teardown_iteration releases it from here on
+            ec2_lease_pool.add(ec2_manager, client_config_dict)
+    elif environment['SCANYWHERE_SERVICE'] == 'hideme_open':
+        host_list = get_hideme_servers()
+        target_host = random.choice([h[0] for h in host_list.values()])
+        logging.info(f"resolve {target_host}")
+        target_ip = socket.gethostbyname(target_host)
+        environment['VPN_ENDPOINT_IP'] = target_ip
+        logging.info(f"pin host to {environment['VPN_ENDPOINT_IP']}")
+        tmp_filename = f"{uuid.uuid4()}.conf"
+        tmp_path = pathlib.Path(".") / "docker" / "gluetun" / tmp_filename
+        file_content = HIDEME_TEMPLATE.replace('VPN_ENDPOINT_IP', target_ip)
+        with open(tmp_path, "w") as file:
+            file.write(file_content)
+        environment["OPENVPN_CUSTOM_CONFIG"] = f"/gluetun/{tmp_filename}"
+    return tmp_path
+
+def run_iteration(client, counter, args, network=""):
+    iteration = connect_iteration(client, counter, args, network)
+    return finish_iteration(client, iteration, args, network)
+
+def connect_iteration(client, counter, args, network="", environment=None, started_containers=None):
+    # first half of an iteration: select the server, take a device slot and connect the vpn
+    time_start = time.time()
+    outcomes = dict()
+    with collect_phases(dict(), outcomes) as phases:
+        environment, tmp_path = prepare_iteration(counter, args, environment)
+        iteration = {
+            "counter": counter,
+            "environment": environment,
+            "tmp_path": tmp_path,
+            "started_containers": list() if started_containers is None else started_containers,
+            "device_slot": None,
+            "gluetun_name": None,
+            "gluetun_environment": None,
+            "time_start": time_start,
+            "phases": phases,
+            "outcomes": outcomes,
+            "success": False,
+            "reason": "connect",
+        }
+        start_checkpoint(iteration)
+        try:
+            iteration["device_slot"] = acquire_device_slot(environment.get('VPN_SERVICE_PROVIDER'))
+            iteration["gluetun_name"], iteration["gluetun_environment"] = connect_containers(client, environment, iteration["started_containers"], network)
+            save_checkpoint()
+        except BaseException as e:
+            teardown_iteration(client, iteration)
+            # e.g. AUTH_FAILED affects every endpoint of the provider, not only this one
+            iteration["reason"] = "fatal" if isinstance(e, GluetunFatalError) else "connect"
+            record_outcome(environment, False, iteration["reason"])
+            record_iteration_phases(iteration, False)
+            raise
+    return iteration
+
+def finish_iteration(client, iteration, args, network=""):
+    # second half of an iteration: run the measurement over the connected vpn and clean up
+    success = False
+    with collect_phases(iteration["phases"], iteration["outcomes"]):
+        try:
+            if iteration["gluetun_name"]:
+                success = measure_containers(client, iteration["gluetun_name"], iteration["gluetun_environment"], args.target_images, iteration["started_containers"], network, args.warp_mode, args.concurrent_images)
+        finally:
+            teardown_iteration(client, iteration)
+            iteration["success"] = success
+            iteration["reason"] = None if success else ("measurement" if iteration["gluetun_name"] else "connect")
+            record_outcome(iteration["environment"], success, iteration["reason"])
+            record_iteration_phases(iteration, success)
+    return success
 
+def record_iteration_phases(iteration, success):
+    environment = iteration["environment"]
+    record_phase_times({
+        "time": time.time(),
+        "counter": iteration["counter"],
+        "session_id": environment.get('SCANYWHERE_SESSION_ID'),
+        "worker": threading.current_thread().name,
+        "provider": environment.get('VPN_SERVICE_PROVIDER'),
+        "vpn_type": environment.get('VPN_TYPE'),
+        "country": environment.get('SERVER_COUNTRIES'),
+        "region": environment.get('SERVER_REGIONS') or environment.get('EC2_REGION'),
+        "success": success,
+        "seconds": round(time.time() - iteration["time_start"], 3),
+        "phases": iteration["phases"],
+        "outcomes": iteration["outcomes"],
+    })
+
+def teardown_iteration(client, iteration):
+    stop_all_started_containers(client, iteration["started_containers"])
+    release_device_slot(iteration["device_slot"])
+    if iteration["tmp_path"]:
+        iteration["tmp_path"].unlink()
+    if ec2_lease_pool and iteration["environment"]['SCANYWHERE_SERVICE'] == 'ec2':
+        # an instance whose tunnel never came up is not reused
+        ec2_lease_pool.release(iteration["environment"].get('VPN_ENDPOINT_IP'), healthy=bool(iteration["gluetun_name"]))
+    if checkpoint:
+        checkpoint.finish(iteration["counter"])
+
+def start_checkpoint(iteration):
+    if checkpoint:
+        checkpoint.start(iteration["counter"], {
+            "time": iteration["time_start"],
+            "selection": get_job_selection(iteration["environment"]),
+            "tmp_path": str(iteration["tmp_path"]) if iteration["tmp_path"] else None,
+            "started_containers": iteration["started_containers"],
+        })
+
+def save_checkpoint():
+    if checkpoint:
+        checkpoint.save()
+
+def get_checkpoint_config(args):
+    # a checkpoint is only resumed with the same selection
+    keys = ["vpn_service", "server_selection", "selection_mode", "countries", "regions", "ec2_regions", "disable_normalization", "target_image", "warp_mode"]
+    return {k: getattr(args, k) for k in keys}
+
+def cleanup_leftovers(client, leftovers):
+    # iterations that were in flight when the last run stopped (ec2 instances terminate via their deadman switch)
+    for counter, info in leftovers.items():
+        logging.info(f"clean up iteration {counter} of the last run")
+        stop_all_started_containers(client, list(info.get("started_containers", [])))
+        if info.get("tmp_path"):
+            pathlib.Path(info["tmp_path"]).unlink(missing_ok=True)
+
+def get_checkpoint(args):
+    config = get_checkpoint_config(args)
+    if args.checkpoint:
+        return Checkpoint(config, args.checkpoint)
+    # several workers may run on one host, each one resumes the first checkpoint that is not in use
+    for slot in itertools.count() if args.mode == "worker" else [None]:
+        try:
+            return Checkpoint(config, get_checkpoint_path(config, args.mode, slot))
+        except CheckpointLockedError:
+            if args.mode != "worker":
+                raise
+
+def get_counters(limit=None):
+    # limit: number of iterations of this run (None: unlimited)
+    return itertools.islice(checkpoint.get_counters() if checkpoint else itertools.count(), limit)
+
+def next_counter(counters):
+    # None once all iterations are handed out
+    with counter_lock:
+        return next(counters, None)
+
+def run_worker(client, counters, args, network=""):
+    while True:
+        counter = next_counter(counters)
+        if counter is None:
+            return
+        try:
+            run_iteration(client, counter, args, network)
+        except:
+            logging.exception(f"iteration {counter} failed...")
+        time.sleep(1)
+
+def run_async(target, *args, name=None):
+    # daemon thread instead of an executor, so a pending call does not block KeyboardInterrupt
+    future = concurrent.futures.Future()
+    phases, outcomes = get_active_phases(), get_active_outcomes()
+    def run():
+        try:
+            with collect_phases(phases, outcomes):
+                future.set_result(target(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=run, name=name or f"{threading.current_thread().name}-{target.__name__}", daemon=True).start()
+    return future
+
+def connect_iteration_async(client, counter, args, network=""):
+    return run_async(connect_iteration, client, counter, args, network, name=f"{threading.current_thread().name}-connect")
+
+def run_pipelined_worker(client, counters, args, network=""):
+    counter = next_counter(counters)
+    pending = connect_iteration_async(client, counter, args, network) if counter is not None else None
+    while pending:
+        try:
+            iteration = pending.result()
+        except:
+            logging.exception("connecting iteration failed...")
+            iteration = None
+            time.sleep(1)
+        # warm up the next vpn while the current measurement is running
+        counter = next_counter(counters)
+        pending = connect_iteration_async(client, counter, args, network) if counter is not None else None
+        if iteration:
+            try:
+                finish_iteration(client, iteration, args, network)
+            except:
+                logging.exception(f"iteration {iteration['counter']} failed...")
+
+def get_job_selection(environment):
+    # only what the selection added, credentials stay on the hosts
+    base = vpn_services[environment['SCANYWHERE_SERVICE']]
+    return {k: v for k, v in environment.items() if base.get(k) != v}
+
+def get_device_limits(services):
+    return {p: DEVICE_LIMITS.get(p) for p in {vpn_services[s]['VPN_SERVICE_PROVIDER'] for s in services}}
+
+def run_coordinator(job_queue, args, queue_size):
+    # owns the endpoint selection (and its coverage state), workers only run the jobs
+    job_queue.set_device_limits(get_device_limits(args.vpn_service))
+    cancelled = job_queue.cancel_pending()
+    if cancelled:
+        logging.info(f"cancelled {cancelled} pending jobs of an earlier coordinator")
+    counters = get_counters()
+    while True:
+        job_queue.expire_leases()
+        for job in job_queue.collect_finished():
+            environment = vpn_services[job['service']] | job['selection']
+            if job['status'] == "expired":
+                logging.warning(f"lease of job {job['id']} expired (worker {job['worker']})")
+            record_outcome(environment, bool(job['success']), job['reason'] or job['status'])
+        for _ in range(queue_size - job_queue.count("pending")):
+            environment = select_environment(next(counters), args)
+            job_queue.put(environment['SCANYWHERE_SERVICE'], environment['VPN_SERVICE_PROVIDER'], get_job_selection(environment))
+        save_checkpoint()
+        time.sleep(JOB_POLL_INTERVAL)
+
+def renew_lease(client, job_queue, job, worker, finished, started_containers):
+    # failed renewals (e.g. a busy database) are retried until the lease would expire
+    lease_expires = time.time() + job_queue.lease_seconds
+    interval = job_queue.lease_seconds / 3
+    while not finished.wait(interval):
+        time_renew = time.time()
+        try:
+            if job_queue.renew(job['id'], worker):
+                lease_expires = time_renew + job_queue.lease_seconds
+                interval = job_queue.lease_seconds / 3
+                continue
+            logging.error(f"lease of job {job['id']} was lost, abort the job")
+        except:
+            logging.exception(f"renewing lease of job {job['id']} failed")
+            if time.time() + LEASE_RETRY_INTERVAL < lease_expires:
+                interval = LEASE_RETRY_INTERVAL
+                continue
+            logging.error(f"lease of job {job['id']} could not be renewed in time, abort the job")
+        if not finished.is_set():
+            # another worker may get the job (and its device slot), stopping the containers fails this run
+            stop_all_started_containers(client, started_containers)
+        return
+
+def run_queue_worker(client, job_queue, args, network=""):
+    worker = get_worker_id()
+    while True:
+        try:
+            job = job_queue.lease(worker)
+        except:
+            # e.g. the coordinator of a remote job queue is restarting
+            logging.exception("leasing a job failed")
+            job = None
+        if not job:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+        logging.info(f"leased job {job['id']} ({job['service']})")
+        finished = threading.Event()
+        # stopped by the lease thread once the lease is lost
+        started_containers = list()
+        threading.Thread(target=renew_lease, args=(client, job_queue, job, worker, finished, started_containers), name=f"{threading.current_thread().name}-lease", daemon=True).start()
+        iteration = None
+        reason = "connect"
+        try:
+            iteration = connect_iteration(client, job['id'], args, network, vpn_services[job['service']] | job['selection'], started_containers)
+            finish_iteration(client, iteration, args, network)
+        except GluetunFatalError:
+            logging.exception(f"job {job['id']} failed...")
+            reason = "fatal"
+        except:
+            logging.exception(f"job {job['id']} failed...")
+        finally:
+            finished.set()
+            try:
+                if iteration:
+                    job_queue.complete(job['id'], worker, iteration["success"], iteration["reason"], iteration["phases"])
+                else:
+                    job_queue.complete(job['id'], worker, False, reason)
+            except:
+                # the coordinator records the job once its lease expired
+                logging.exception(f"completing job {job['id']} failed")
+
+def run_workers(client, args, network=""):
+    # before any worker starts, a missing image would fail every iteration
+    for target_image in args.target_images:
+        check_image(client, target_image)
+    if args.parallel > 1 or args.pipeline or args.mode == "worker":
+        # a pipelined worker holds up to two tunnels (the measured one and the warming one)
+        tunnels_per_worker = 2 if args.pipeline else 1
+        # the workers share the devices of all selected services
+        limits = [DEVICE_LIMITS.get(p) for p in {vpn_services[s].get('VPN_SERVICE_PROVIDER') for s in args.vpn_service}]
+        limit = sum(limits) if all(limits) else None
+        if limit and args.parallel * tunnels_per_worker > limit:
+            max_workers = max(1, limit // tunnels_per_worker)
+            logging.warning(f"{', '.join(args.vpn_service)} allow at most {limit} devices, reducing parallel workers from {args.parallel} to {max_workers}")
+            args.parallel = max_workers
+        counters = get_counters(args.iterations)
+        if args.mode == "worker":
+            # endpoints and device slots are handed out by the coordinator
+            job_queue = open_job_queue(args.job_queue)
+            workers = [threading.Thread(target=run_queue_worker, args=(client, job_queue, args, network), name=f"worker-{n}", daemon=True) for n in range(args.parallel)]
+        else:
+            worker_target = run_pipelined_worker if args.pipeline else run_worker
+            workers = [threading.Thread(target=worker_target, args=(client, counters, args, network), name=f"worker-{n}", daemon=True) for n in range(args.parallel)]
+        for worker in workers:
+            worker.start()
+        # join with timeout to allow easier exit via KeyboardInterrupt
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(1)
+    else:
+        for i in get_counters(args.iterations):
+            try:
+                run_iteration(client, i, args, network)
+            except Exception:
+                logging.exception(f"iteration {i} failed...")
+
+            # sleep to allow easier exit via KeyboardInterrupt
+            time.sleep(1)
+
+def remove_network(client, network):
+    if not network:
+        return
+    try:
+        client.networks.get(network).remove()
+        if checkpoint:
+            checkpoint.remove_network(network)
+    except:
+        logging.error(f"error removing network {network}")
+
+vpn_services = {
+    'nord_open' : ENVIRONMENT_NORD_OPENVPN,
+    'nord_wg' : ENVIRONMENT_NORD_WIREGUARD,
+    'mullvad_open' : ENVIRONMENT_MULLVAD_OPENVPN,
+    'mullvad_wg' : ENVIRONMENT_MULLVAD_WIREGUARD,
+    'surfshark_open' : ENVIRONMENT_SURFSHARK_OPENVPN,
+    'surfshark_wg' : ENVIRONMENT_SURFSHARK_WIREGUARD,
+    'proton_open' : ENVIRONMENT_PROTONVPN_OPENVPN,
+    'pia_open' : ENVIRONMENT_PIA_OPENVPN,
+    'hma_open' : ENVIRONMENT_HIDEMYASS_OPENVPN,
+    'cyberghost_open' : ENVIRONMENT_CYBERGHOST_OPENVPN,
+    'ivpn_open' : ENVIRONMENT_IVPN_OPENVPN,
+    'ivpn_wg' : ENVIRONMENT_IVPN_WG,
+    'hideme_open': ENVIRONMENT_HIDEME_OPENVPN,
+    'ec2' : ENVIRONMENT_BASE_EC2,
+    'surfshark_open_india' : ENVIRONMENT_SURFSHARK_OPENVPN | {"SERVER_COUNTRIES" : "India"},
+    'proton_open_india' : ENVIRONMENT_PROTONVPN_OPENVPN | {"SERVER_COUNTRIES" : "India"},
+    'hma_missing' : ENVIRONMENT_HIDEMYASS_OPENVPN | {"SERVER_COUNTRIES" : "Russia, Belarus, Faroe Islands, Antiguaand Barbuda, Bermuda, Dominican Republic, Jordan, Kuwait, Oman, Maldives, Sudan, Tanzania, Namibia"},
+    'surfshark_germany' : ENVIRONMENT_SURFSHARK_OPENVPN | {"SERVER_COUNTRIES" : "Germany"},
+    'warp_wg': ENVIRONMENT_BASE_WARP,
+    'tor': ENVIRONMENT__BASE_TOR,
+}
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='TODO')
-    parser.add_argument('--target_image', default='check-ip-connectivity')
+    parser.add_argument('--target_image', default='check-ip-connectivity') # comma separated, all images are measured over the same connection
+    parser.add_argument('--concurrent_images', action='store_true') # run all target images at the same time instead of one after another
     parser.add_argument('--vpn_service',
+                        nargs='+', # several services share the workers
                         choices=vpn_services.keys(),
                         required=True)
-    parser.add_argument('--server_selection', choices=['random', 'iterative'], default='random')
+    parser.add_argument('--server_selection', choices=['random', 'iterative', 'coverage'], default='random')
+    parser.add_argument('--selection_mode', choices=['location', 'endpoint'], default='location') # sample countries/regions or concrete servers
     parser.add_argument('--prune_containers', action='store_true')
+    parser.add_argument('--rebuild', action='store_true') # build images even if their build context did not change
     parser.add_argument('--warp_mode', choices=['off', 'warp', 'dual'], default='off')
+    parser.add_argument('--warp_profile_uses', type=int, default=10) # connections per registered warp account
     parser.add_argument('--countries') #vpn countries or tor countries
     parser.add_argument('--regions') # vpn regions or ec2 regions
     parser.add_argument('--ec2_regions')
+    parser.add_argument('--ec2_prelaunch', type=int, default=0) # ec2 instances launched concurrently ahead of their iteration (0: launch on demand)
+    parser.add_argument('--ec2_reuse', type=int, default=1) # iterations per ec2 instance (1: a new instance per iteration)
+    parser.add_argument('--ec2_reuse_minutes', type=int, default=30) # lifetime of a reused ec2 instance
     parser.add_argument('--tor_countries')
     parser.add_argument('--disable_normalization', action='store_true')
-    args = parser.parse_args()
+    parser.add_argument('--parallel', type=int, default=1) # number of gluetun/measurement pairs in flight
+    parser.add_argument('--pipeline', action='store_true') # connect the next vpn while the current measurement runs
+    parser.add_argument('--ingest_results', action='store_true') # per-run result directories, ingested into results.sqlite
+    parser.add_argument('--mode', choices=['standalone', 'coordinator', 'worker'], default='standalone') # coordinator selects endpoints, workers (on any host) run them
+    parser.add_argument('--job_queue', default='jobs.sqlite') # job queue shared by coordinator and workers (workers on other hosts: url of the coordinator)
+    parser.add_argument('--job_queue_listen') # host:port the coordinator serves the job queue on for workers on other hosts
+    parser.add_argument('--queue_size', type=int) # pending jobs kept by the coordinator (default: device limit of all services)
+    parser.add_argument('--iterations', type=int) # stop after this many iterations (default: run until interrupted, not in worker mode)
+    parser.add_argument('--checkpoint') # progress of the campaign, resumed after a restart (default: checkpoint[_<mode>]_<config hash>.json)
+    args = parser.parse_args(argv)
+    args.target_images = args.target_image.split(",")
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
     
-    if args.ec2_regions and not args.vpn_service == 'ec2':
+    if args.ec2_regions and 'ec2' not in args.vpn_service:
         exit("ec2_regions can only be set in combination with ec2 vpn_service")
     #elif args.countries and args.regions:
     #    exit("set either countries or regions (depends on vpn_service)")
+    if args.mode == "worker" and args.pipeline:
+        exit("pipeline is not supported in worker mode")
+    if args.mode == "coordinator" and is_remote(args.job_queue):
+        exit("the coordinator needs a local job_queue, serve it via job_queue_listen")
 
-    client = docker.from_env()
+    # refuses to start (and to clean up) while another process runs with the same checkpoint
+    try:
+        checkpoint = get_checkpoint(args)
+    except CheckpointLockedError as e:
+        exit(str(e))
+
+    if args.mode == "coordinator":
+        coverage_scheduler = CoverageScheduler(global_countries=len(args.vpn_service) > 1)
+        connect_timeouts = ConnectTimeouts()
+        limits = get_device_limits(args.vpn_service).values()
+        queue_size = args.queue_size or (sum(limits) if all(limits) else 10)
+        job_queue = JobQueue(args.job_queue)
+        if args.job_queue_listen:
+            serve_job_queue(job_queue, args.job_queue_listen)
+        run_coordinator(job_queue, args, queue_size)
+
+    # one pooled connection per worker thread
+    client = docker.from_env(max_pool_size=max(10, 2 * args.parallel))
+    # subscribe to container events before the first container is started
+    get_container_events(client)
+    # leftovers of earlier (crashed) runs
+    cleanup_leftovers(client, checkpoint.leftovers)
+    collect_garbage(client, containers=checkpoint.get_leftover_containers(), networks=checkpoint.leftover_networks)
+    # successful/failed runs per endpoint are recorded in every selection mode (by the coordinator in worker mode)
+    if args.mode != "worker":
+        coverage_scheduler = CoverageScheduler(global_countries=len(args.vpn_service) > 1)
+    connect_timeouts = ConnectTimeouts()
+    if args.ingest_results:
+        result_ingester = ResultIngester(results_roots=[f"docker/{image}/results" for image in args.target_images])
     
     if args.prune_containers:
-        prune_docker_images(client, args.target_image)
+        for target_image in args.target_images:
+            prune_docker_images(client, target_image)
 
-    # build local image
-    build_container(client, args.target_image)
+    # build local images (in parallel, skipped if their build context did not change)
+    images = list(args.target_images)
+    if args.warp_mode in ['warp', 'dual']:
+        images.append("gluetun-warp")
+    if 'tor' in args.vpn_service:
+        images.append("gluetor")
+    outcomes = dict()
+    with collect_phases(dict(), outcomes) as phases:
+        build_containers(client, images, args.rebuild)
+    record_phase_times({"time": time.time(), "counter": None, "images": images, "phases": phases, "outcomes": outcomes})
     
     network=""
     if args.warp_mode in ['warp', 'dual']:
-        # build_warp_container
-        build_container(client, "gluetun-warp")
-        network = client.networks.create(f"{uuid.uuid4()}").name
-    if args.vpn_service == 'tor':
-        build_container(client, "gluetor")
-    
-    for i in itertools.count():
-        tmp_path = None
+        network = client.networks.create(f"{uuid.uuid4()}", labels={CONTAINER_LABEL: ""}).name
+        # removed by the next run if this one crashes
+        checkpoint.add_network(network)
+        # warp accounts are registered in the background (through the first hop) instead of once per warp hop
+        warp_profile_pool = WarpProfilePool(lambda via: register_warp_profile(client, via), max_uses=args.warp_profile_uses, min_size=max(3, args.parallel))
     
-        environment = prepare_environment(i, args.vpn_service, args.countries, args.regions, args.server_selection, not args.disable_normalization)
-        if args.vpn_service == 'ec2':
-            ec2_manager = EC2Manager(region=environment.get('EC2_REGION'))
-            client_config_dict = ec2_manager.start_instance_wg()
-            environment |= client_config_dict
-        elif args.vpn_service == 'hideme_open':
-            host_list = get_hideme_servers()
-            target_host = random.choice([h[0] for h in host_list.values()])
-            logging.info(f"resolve {target_host}")
-            target_ip = socket.gethostbyname(target_host)
-            environment['VPN_ENDPOINT_IP'] = target_ip
-            logging.info(f"pin host to {environment['VPN_ENDPOINT_IP']}")
-            tmp_filename = f"{uuid.uuid4()}.conf"
-            tmp_path = pathlib.Path(".") / "docker" / "gluetun" / tmp_filename
-            file_content = HIDEME_TEMPLATE.replace('VPN_ENDPOINT_IP', target_ip)
-            with open(tmp_path, "w") as file:
-                file.write(file_content)
-            environment["OPENVPN_CUSTOM_CONFIG"] = f"/gluetun/{tmp_filename}"
-        
-
-        start_containers(client, environment, args.target_image, network, args.warp_mode)
+    if 'ec2' in args.vpn_service and args.ec2_prelaunch:
+        ec2_fleet = EC2Fleet(size=args.ec2_prelaunch)
+    if 'ec2' in args.vpn_service and args.ec2_reuse > 1:
+        ec2_lease_pool = EC2LeasePool(max_uses=args.ec2_reuse, max_age=args.ec2_reuse_minutes*60)
 
-        if tmp_path:
-            tmp_path.unlink()
-
-        # sleep to allow easier exit via KeyboardInterrupt
-        time.sleep(1)
\ No newline at end of file
+    try:
+        run_workers(client, args, network)
+    except UnknownImageError as e:
+        exit(str(e))
+    finally:
+        remove_network(client, network)
+        if ec2_fleet:
+            ec2_fleet.stop()
+        if ec2_lease_pool:
+            ec2_lease_pool.stop()
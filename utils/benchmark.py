@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import argparse
+import importlib
+import itertools
+import tempfile
+import threading
+import statistics
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.phase_timing import read_phase_times, percentile
+
+logger = logging.getLogger(__name__)
+
+FAKE_PUBLIC_IP = "198.51.100.7"
+FAKE_COUNTRY = "Austria"
+
+FAKE_WGCF_PROFILE = """[Interface]
+PrivateKey = cGhhbnRvbS1wcml2YXRlLWtleS1mb3ItYmVuY2htYXJrcw=
+Address = 172.16.0.2/32
+Address = 2606:4700:110:8a36::2/128
+DNS = 1.1.1.1
+MTU = 1280
+[Peer]
+PublicKey = bmN3oG3QEPwcfg7a3bCx1kMqkbJk0zDTLf2D1mrK2Fo=
+AllowedIPs = 0.0.0.0/0
+Endpoint = engage.cloudflareclient.com:2408
+"""
+
+# servers.json of the fake providers, enough for every server selection
+FAKE_LOCATIONS = {
+    "Austria": ["Vienna"],
+    "Germany": ["Berlin", "Frankfurt"],
+    "Sweden": ["Stockholm"],
+    "Switzerland": ["Zurich"],
+}
+
+
+class FakeGluetunApi():
+    '''Local stand-in for the gluetun control server (only /v1/publicip/ip).'''
+
+    def __init__(self, port, public_ip=FAKE_PUBLIC_IP, country=FAKE_COUNTRY):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/v1/publicip/ip":
+                    self.send_error(404)
+                    return
+                body = json.dumps({"public_ip": public_ip, "country": country}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeContainer():
+    def __init__(self, client, name, image, kwargs):
+        self.client = client
+        self.name = name
+        self.id = name
+        self.status = "running"
+        self.exit_code = None
+        self.remove_on_exit = kwargs.get("remove", False)
+        self.labels = list(kwargs.get("labels") or [])
+        self.ports = kwargs.get("ports") or {}
+        self.environment = kwargs.get("environment") or {}
+        self.attrs = {
+            "Config": {"Image": image, "Env": [f"{k}={v}" for k, v in self.environment.items()], "Labels": {l: "" for l in self.labels}},
+            "NetworkSettings": {"IPAddress": "172.17.0.2"},
+        }
+        self.lines = list()
+        self.changed = threading.Condition()
+        self.api = None
+
+    def log(self, line):
+        with self.changed:
+            self.lines.append(f"{time.strftime('%Y-%m-%dT%H:%M:%SZ')} {line}\n".encode())
+            self.changed.notify_all()
+
+    def stream_logs(self):
+        # like a followed log stream: all lines so far, then new ones until the container exits
+        position = 0
+        while True:
+            with self.changed:
+                while position == len(self.lines) and self.status == "running":
+                    self.changed.wait()
+                lines = self.lines[position:]
+                position = len(self.lines)
+                running = self.status == "running"
+            yield from lines
+            if not running and position == len(self.lines):
+                return
+
+    def exit(self, exit_code):
+        with self.changed:
+            if self.status != "running":
+                return
+            self.status = "exited"
+            self.exit_code = exit_code
+            self.changed.notify_all()
+        if self.api:
+            # not part of the stop latency of the real daemon
+            threading.Thread(target=self.api.close, daemon=True).start()
+        self.client.container_died(self)
+
+    def reload(self):
+        self.client.call()
+
+    def logs(self, **kwargs):
+        self.client.call()
+        with self.changed:
+            return b"".join(self.lines)
+
+    def stop(self, timeout=10):
+        self.client.call()
+        time.sleep(self.client.stop_delay)
+        self.exit(0)
+
+    def kill(self):
+        self.client.call()
+        self.exit(137)
+
+    def remove(self, force=False):
+        self.client.call()
+        if self.status == "running" and not force:
+            raise RuntimeError(f"container {self.name} is running")
+        self.exit(137)
+        self.client.forget(self)
+
+    def wait(self, timeout=None):
+        with self.changed:
+            self.changed.wait_for(lambda: self.status != "running", timeout)
+        return {"StatusCode": self.exit_code}
+
+
+class FakeContainers():
+    def __init__(self, client):
+        self.client = client
+
+    def run(self, image, detach=False, **kwargs):
+        return self.client.run(image, detach, kwargs)
+
+    def get(self, container_id):
+        self.client.call()
+        with self.client.lock:
+            container = self.client.containers_by_name.get(container_id)
+        if container is None:
+            raise KeyError(f"No such container: {container_id}")
+        return container
+
+    def list(self, all=False, filters=None):
+        self.client.call()
+        with self.client.lock:
+            containers = list(self.client.containers_by_name.values())
+        return [c for c in containers if all or c.status == "running"]
+
+    def prune(self, filters=None):
+        self.client.call()
+        deleted = [c.name for c in self.list(all=True) if c.status != "running"]
+        for name in deleted:
+            self.client.forget(self.get(name))
+        return {"ContainersDeleted": deleted, "SpaceReclaimed": 0}
+
+
+class FakeApi():
+    def __init__(self, client):
+        self.client = client
+
+    def logs(self, container, stream=False, follow=False, **kwargs):
+        container = self.client.containers.get(container)
+        if stream and follow:
+            return container.stream_logs()
+        return container.logs()
+
+    def containers(self, all=False, size=False, filters=None):
+        return [{"Id": c.id, "SizeRw": 0} for c in self.client.containers.list(all=all)]
+
+
+class FakeImages():
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, name):
+        self.client.call()
+        return name
+
+    def build(self, **kwargs):
+        self.client.call()
+        return kwargs.get("tag"), []
+
+    def prune(self, filters=None):
+        return {}
+
+
+class FakeNetwork():
+    def __init__(self, client, name, labels):
+        self.client = client
+        self.name = name
+        self.attrs = {"Labels": labels or {}}
+        self.containers = []
+
+    def reload(self):
+        self.client.call()
+
+    def remove(self):
+        self.client.call()
+        with self.client.lock:
+            self.client.networks_by_name.pop(self.name, None)
+
+
+class FakeNetworks():
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, name, labels=None, **kwargs):
+        self.client.call()
+        network = FakeNetwork(self.client, name, labels)
+        with self.client.lock:
+            self.client.networks_by_name[name] = network
+        return network
+
+    def get(self, name):
+        self.client.call()
+        with self.client.lock:
+            network = self.client.networks_by_name.get(name)
+        if network is None:
+            raise KeyError(f"No such network: {name}")
+        return network
+
+    def list(self, **kwargs):
+        self.client.call()
+        with self.client.lock:
+            return list(self.client.networks_by_name.values())
+
+    def prune(self, filters=None):
+        self.client.call()
+        return {"NetworksDeleted": []}
+
+
+class FakeDockerClient():
+    '''In-process stand-in for docker.DockerClient, enough to run scanywhere containers.
+
+    Every gluetun container (any image containing "gluetun") gets a local
+    FakeGluetunApi on its published api port after connect_delay seconds and
+    logs its public ip (unless log_ready is False, then only the control server
+    tells). With failure_rate it logs an unrecoverable error instead, with
+    exit_rate it dies while connecting. Measurement containers exit after
+    measure_time, every call to the daemon takes api_latency seconds.
+    '''
+
+    def __init__(self, connect_delay=5, measure_time=1, stop_delay=0.1, api_latency=0.01, failure_rate=0, exit_rate=0, log_ready=True, seed=None):
+        self.connect_delay = connect_delay
+        self.measure_time = measure_time
+        self.stop_delay = stop_delay
+        self.api_latency = api_latency
+        self.failure_rate = failure_rate
+        self.exit_rate = exit_rate
+        self.log_ready = log_ready
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.names = itertools.count()
+        self.containers_by_name = dict()
+        self.networks_by_name = dict()
+        self.subscribers = list()
+        self.calls = 0
+        self.containers = FakeContainers(self)
+        self.api = FakeApi(self)
+        self.images = FakeImages(self)
+        self.networks = FakeNetworks(self)
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+    def run(self, image, detach, kwargs):
+        self.call()
+        container = FakeContainer(self, kwargs.get("name") or f"fake_{next(self.names)}", image, kwargs)
+        with self.lock:
+            self.containers_by_name[container.name] = container
+        if not detach:
+            # e.g. the wgcf registration, blocks and returns the output
+            time.sleep(self.measure_time)
+            self.forget(container)
+            return FAKE_WGCF_PROFILE.encode()
+        target = self.simulate_gluetun if "gluetun" in image else self.simulate_measurement
+        threading.Thread(target=target, args=(container,), daemon=True).start()
+        return container
+
+    def simulate_gluetun(self, container):
+        container.log("INFO [routing] default route found")
+        with self.lock:
+            outcome = self.random.random()
+        time.sleep(self.connect_delay)
+        if outcome < self.exit_rate:
+            container.log("ERROR [vpn] exiting")
+            container.exit(1)
+        elif outcome < self.exit_rate + self.failure_rate:
+            container.log("ERROR [openvpn] AUTH_FAILED")
+        else:
+            for port, (host, host_port) in container.ports.items():
+                container.api = FakeGluetunApi(host_port)
+            if self.log_ready:
+                container.log(f"INFO [ip getter] Public IP address is {FAKE_PUBLIC_IP} ({FAKE_COUNTRY}, Vienna, Vienna)")
+
+    def simulate_measurement(self, container):
+        container.log("measurement started")
+        time.sleep(self.measure_time)
+        container.log("measurement finished")
+        container.exit(0)
+
+    def container_died(self, container):
+        event = {
+            "Type": "container",
+            "Action": "die",
+            "time": int(time.time()),
+            "Actor": {"ID": container.id, "Attributes": {"name": container.name, "exitCode": str(container.exit_code)}},
+        }
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
+        if container.remove_on_exit:
+            self.forget(container)
+
+    def forget(self, container):
+        with self.lock:
+            self.containers_by_name.pop(container.name, None)
+
+    def events(self, decode=True, since=None, filters=None):
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.append(subscriber)
+        while True:
+            yield subscriber.get()
+
+
+def get_fake_servers():
+    servers = list()
+    for n, (country, regions) in enumerate(FAKE_LOCATIONS.items()):
+        for m, region in enumerate(regions):
+            for vpn in ["openvpn", "wireguard"]:
+                servers.append({"vpn": vpn, "country": country, "region": region, "city": region,
+                                "hostname": f"{country[:2].lower()}-{region[:3].lower()}-{vpn[:2]}",
+                                "ips": [f"203.0.113.{10 * n + 2 * m + i}" for i in range(2)]})
+    # every provider offers the same fake servers
+    return {provider: {"servers": servers} for provider in ["mullvad", "nordvpn", "surfshark", "protonvpn", "ivpn", "cyberghost", "hidemyass", "private internet access"]}
+
+def import_scanywhere(work_dir, target_images):
+    # scanywhere reads credentials.json and servers.json (and writes its statistics) relative to the working directory
+    os.chdir(work_dir)
+    Path("credentials.json").write_text("{}")
+    for directory in ["gluetun"] + target_images:
+        (Path("docker") / directory / "results").mkdir(parents=True, exist_ok=True)
+    Path("docker/gluetun/servers.json").write_text(json.dumps(get_fake_servers()))
+    # the empty credentials are expected, do not log every missing key
+    logging.disable(logging.ERROR)
+    try:
+        return importlib.import_module("scanywhere")
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def run_benchmark(scanywhere, client, args):
+    # the state main sets up for a standalone run, then the workers of the orchestrator itself
+    scanywhere.checkpoint = scanywhere.Checkpoint(scanywhere.get_checkpoint_config(args), "checkpoint.json")
+    scanywhere.coverage_scheduler = scanywhere.CoverageScheduler(global_countries=len(args.vpn_service) > 1)
+    scanywhere.connect_timeouts = scanywhere.ConnectTimeouts()
+    scanywhere.get_container_events(client)
+    network = ""
+    if args.warp_mode != "off":
+        network = client.networks.create(f"benchmark-{os.getpid()}", labels={scanywhere.CONTAINER_LABEL: ""}).name
+        scanywhere.checkpoint.add_network(network)
+        scanywhere.warp_profile_pool = scanywhere.WarpProfilePool(lambda via: scanywhere.register_warp_profile(client, via), max_uses=args.warp_profile_uses, min_size=max(3, args.parallel))
+    time_start = time.time()
+    try:
+        scanywhere.run_workers(client, args, network)
+    finally:
+        scanywhere.remove_network(client, network)
+    seconds = time.time() - time_start
+    # every iteration appends its phases to phase_times.jsonl (the image build record has no counter)
+    results = [{"success": r["success"], "seconds": r["seconds"], "phases": r["phases"]} for r in read_phase_times() if r.get("counter") is not None]
+    return results, seconds
+
+
+def get_scanywhere_argv(args):
+    argv = ["--vpn_service"] + args.vpn_service.split(",") + [
+        "--target_image", args.target_image,
+        "--server_selection", args.server_selection,
+        "--selection_mode", args.selection_mode,
+        "--warp_mode", args.warp_mode,
+        "--parallel", str(args.parallel),
+        "--iterations", str(args.iterations),
+    ]
+    if args.concurrent_images:
+        argv.append("--concurrent_images")
+    if args.pipeline:
+        argv.append("--pipeline")
+    return argv
+
+
+def get_simulated_times(client, target_images, warp_mode="off", concurrent=False, pipeline=False):
+    # time of a phase that is spent in the fake itself, the rest is orchestration overhead
+    measurements = client.measure_time * (1 if concurrent else len(target_images))
+    if warp_mode == "warp":
+        iteration = 2 * client.connect_delay + measurements
+    elif warp_mode == "dual":
+        # the warp hop connects while the first measurements run
+        iteration = client.connect_delay + max(client.connect_delay, measurements) + measurements
+    else:
+        iteration = client.connect_delay + measurements
+    simulated = {
+        "run_gluetun_extended": client.connect_delay,
+        "warponize_container": client.connect_delay,
+        "run_measurement": client.measure_time,
+        "stop_all_started_containers": client.stop_delay,
+        "iteration": iteration + client.stop_delay,
+    }
+    if pipeline:
+        # a pipelined iteration also waits connected for the measurement of the previous one
+        del simulated["iteration"]
+    return simulated
+
+
+def get_report(results, seconds, simulated):
+    phases = {"iteration": [r["seconds"] for r in results]}
+    for r in results:
+        for phase, times in r["phases"].items():
+            phases.setdefault(phase, []).extend(times)
+    report = {
+        "iterations": len(results),
+        "successful": sum(r["success"] for r in results),
+        "seconds": round(seconds, 3),
+        "iterations_per_second": round(len(results) / seconds, 3) if seconds else None,
+        "phases": dict(),
+    }
+    for phase, times in sorted(phases.items()):
+        times = sorted(times)
+        mean = statistics.mean(times)
+        report["phases"][phase] = {
+            "n": len(times),
+            "mean": round(mean, 3),
+            "p50": round(percentile(times, 50), 3),
+            "p90": round(percentile(times, 90), 3),
+            "overhead": round(mean - simulated[phase], 3) if phase in simulated else None,
+        }
+    return report
+
+
+def get_backoff_report(coverage_scheduler):
+    # failure reasons and backed off endpoints as recorded by the coverage bookkeeping
+    reasons = dict()
+    backed_off = 0
+    for entry in coverage_scheduler.entries.values():
+        for failure in entry['failure_history']:
+            reasons[failure['reason']] = reasons.get(failure['reason'], 0) + 1
+        if coverage_scheduler.is_backed_off(entry['provider'], entry):
+            backed_off += 1
+    return {"failure_reasons": reasons, "backed_off_endpoints": backed_off}
+
+
+def check_backoff(report, exit_rate):
+    # AUTH_FAILED (--failure_rate) is provider-wide, only dying gluetun containers (--exit_rate) may back off endpoints
+    if exit_rate == 0 and report["backed_off_endpoints"]:
+        return f"{report['backed_off_endpoints']} endpoints backed off without a failure to connect"
+    return None
+
+
+def print_report(report):
+    print(f"{report['iterations']} iterations ({report['successful']} successful) in {report['seconds']:.1f}s: {report['iterations_per_second']:.2f} iterations/s")
+    print(f"{'phase':<30} {'n':>6} {'mean[s]':>8} {'p50[s]':>8} {'p90[s]':>8} {'overhead[s]':>12}")
+    for phase, s in report["phases"].items():
+        overhead = f"{s['overhead']:.3f}" if s["overhead"] is not None else "-"
+        print(f"{phase:<30} {s['n']:>6} {s['mean']:>8.3f} {s['p50']:>8.3f} {s['p90']:>8.3f} {overhead:>12}")
+    if report["failure_reasons"]:
+        reasons = ", ".join(f"{reason} {count}" for reason, count in sorted(report["failure_reasons"].items(), key=lambda x: str(x[0])))
+        print(f"failures: {reasons}; {report['backed_off_endpoints']} endpoints backed off")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the orchestration against a fake docker daemon and gluetun api (no vpn subscription needed)')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--parallel', type=int, default=1) # reduced to the device limit of the services, as by scanywhere
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--vpn_service', default='mullvad_open') # comma separated, all of them use the fake servers
+    parser.add_argument('--server_selection', choices=['random', 'iterative', 'coverage'], default='random')
+    parser.add_argument('--selection_mode', choices=['location', 'endpoint'], default='location')
+    parser.add_argument('--target_image', default='check-ip-connectivity') # comma separated
+    parser.add_argument('--concurrent_images', action='store_true')
+    parser.add_argument('--warp_mode', choices=["off", "warp", "dual"], default="off")
+    parser.add_argument('--connect_delay', type=float, default=2) # seconds until a fake gluetun is connected
+    parser.add_argument('--measure_time', type=float, default=1) # seconds a fake measurement runs
+    parser.add_argument('--stop_delay', type=float, default=0.1)
+    parser.add_argument('--api_latency', type=float, default=0.01) # seconds per call to the fake daemon
+    parser.add_argument('--failure_rate', type=float, default=0) # share of connects failing with AUTH_FAILED
+    parser.add_argument('--exit_rate', type=float, default=0) # share of gluetun containers dying while connecting
+    parser.add_argument('--no_log_ready', action='store_true') # only the control server reports the public ip
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output') # write the report as json, e.g. to compare two revisions
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    target_images = args.target_image.split(",")
+    output = Path(args.output).absolute() if args.output else None
+    with tempfile.TemporaryDirectory(prefix="scanywhere-benchmark-") as work_dir:
+        scanywhere = import_scanywhere(work_dir, target_images)
+        logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+        client = FakeDockerClient(args.connect_delay, args.measure_time, args.stop_delay, args.api_latency,
+                                  args.failure_rate, args.exit_rate, not args.no_log_ready, args.seed)
+        scanywhere_args = scanywhere.parse_args(get_scanywhere_argv(args))
+        results, seconds = run_benchmark(scanywhere, client, scanywhere_args)
+        report = get_report(results, seconds, get_simulated_times(client, target_images, args.warp_mode, args.concurrent_images, args.pipeline))
+        report |= get_backoff_report(scanywhere.coverage_scheduler)
+        report["config"] = vars(args) | {"docker_calls": client.calls}
+    print_report(report)
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+    error = check_backoff(report, args.exit_rate)
+    if error:
+        exit(error)
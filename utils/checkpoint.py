@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import json
+import fcntl
+import time
+import hashlib
+import logging
+import argparse
+import itertools
+import threading
+
+logger = logging.getLogger(__name__)
+
+PATH_CHECKPOINT = "checkpoint.json"
+
+
+class CheckpointLockedError(Exception):
+    pass
+
+
+def get_checkpoint_path(config, mode="standalone", slot=None):
+    # one checkpoint per configuration, so that runs with another selection do not take over its leftovers
+    digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+    name = "_".join(str(part) for part in ["checkpoint", mode if mode != "standalone" else None, digest, slot] if part is not None)
+    return f"{name}.json"
+
+
+class Checkpoint():
+    '''Progress of a campaign: the next counter and the iterations in flight.
+
+    Saved whenever an iteration starts, changes or finishes. The process holds
+    an exclusive lock on the checkpoint for its lifetime, a second process with
+    the same checkpoint raises CheckpointLockedError (before it could take the
+    iterations in flight of the first one for leftovers). A checkpoint is only
+    resumed by a run with the same config (e.g. services and selection),
+    otherwise the campaign starts over. Iterations that were in flight when the
+    earlier run stopped are available as leftovers (to clean up) and their
+    counters are handed out again first. Networks created by the campaign are
+    recorded as well; those of the earlier run are leftover_networks also if
+    the config changed, since the lock shows that this run is no longer alive.
+    '''
+
+    def __init__(self, config, path=PATH_CHECKPOINT):
+        self.config = config
+        self.path = path
+        self.lock = threading.Lock()
+        self.next_counter = 0
+        self.in_flight = dict()
+        self.leftovers = dict()
+        self.networks = list()
+        self.leftover_networks = list()
+        self.lock_file = self.acquire()
+        self.load()
+
+    def acquire(self):
+        # kept open (and locked) until the process exits
+        lock_file = open(f"{self.path}.lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise CheckpointLockedError(f"checkpoint {self.path} is in use by another scanywhere process")
+        return lock_file
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return
+        except:
+            logger.error(f"error reading checkpoint {self.path}, starting over")
+            return
+        self.leftover_networks = state.get('networks', [])
+        if state.get('config') != self.config:
+            logger.info(f"checkpoint {self.path} belongs to another configuration, starting over")
+            return
+        self.next_counter = state['next_counter']
+        self.leftovers = {int(counter): info for counter, info in state.get('in_flight', {}).items()}
+        logger.info(f"resuming at counter {self.next_counter} ({len(self.leftovers)} iterations were in flight)")
+
+    def save(self):
+        with self.lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump({
+                    'config': self.config,
+                    'time': time.time(),
+                    'next_counter': self.next_counter,
+                    'in_flight': {str(counter): info for counter, info in self.in_flight.items()},
+                    'networks': self.networks,
+                }, file)
+            os.replace(tmp_path, self.path)
+
+    def get_counters(self):
+        # not thread safe (like itertools.count), callers serialize next()
+        for counter in itertools.chain(sorted(self.leftovers), itertools.count(self.next_counter)):
+            with self.lock:
+                self.next_counter = max(self.next_counter, counter + 1)
+            yield counter
+
+    def start(self, counter, info):
+        # info is kept as reference, so later changes (e.g. started containers) are part of the next save
+        with self.lock:
+            self.in_flight[counter] = info
+        self.save()
+
+    def finish(self, counter):
+        with self.lock:
+            self.in_flight.pop(counter, None)
+        self.save()
+
+    def add_network(self, name):
+        with self.lock:
+            self.networks.append(name)
+        self.save()
+
+    def remove_network(self, name):
+        with self.lock:
+            if name in self.networks:
+                self.networks.remove(name)
+        self.save()
+
+    def get_leftover_containers(self):
+        return [name for info in self.leftovers.values() for name in info.get("started_containers", [])]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='print checkpoints')
+    parser.add_argument('--path') # default: all checkpoints in the current directory
+    args = parser.parse_args()
+
+    for path in [args.path] if args.path else sorted(glob.glob("checkpoint*.json")):
+        with open(path) as file:
+            state = json.load(file)
+        print(f"{path}: saved {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['time']))}, next counter {state['next_counter']}")
+        print(f"config {json.dumps(state['config'])}")
+        for counter, info in state['in_flight'].items():
+            print(f"in flight: {counter} {json.dumps(info)}")
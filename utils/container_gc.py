@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import gzip
+import time
+import logging
+import argparse
+from pathlib import Path
+from datetime import datetime, timezone
+try:
+    from utils.docker_events import CONTAINER_LABEL
+except ModuleNotFoundError:
+    # run as script (python utils/container_gc.py)
+    from docker_events import CONTAINER_LABEL
+
+logger = logging.getLogger(__name__)
+
+PATH_TEMP_CONFIGS = "docker/gluetun"
+# temp configs are named by uuid4
+UUID_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+# younger stopped containers may belong to another scanywhere process that did not archive them yet
+MIN_CONTAINER_AGE = 60*60
+
+
+def get_container_image(container):
+    return container.attrs.get("Config", {}).get("Image", "").split(":")[0]
+
+def parse_docker_time(value):
+    # e.g. "2024-05-01T12:00:00.123456789Z", FinishedAt is "0001-01-01T00:00:00Z" for containers that never ran
+    try:
+        seconds = datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+        return seconds if seconds > 0 else None
+    except:
+        return None
+
+def get_container_age(container):
+    # seconds since the container was created resp. finished
+    times = [parse_docker_time(container.attrs.get("Created")), parse_docker_time(container.attrs.get("State", {}).get("FinishedAt"))]
+    times = [t for t in times if t]
+    return time.time() - max(times) if times else 0
+
+def get_log_archive_path(container_name, image, results_dir=None):
+    # next to the results of the run (resp. in a logs folder of the shared results folder)
+    if results_dir:
+        return Path(results_dir) / f"{container_name}.log.gz"
+    return Path("docker") / image / "results" / "logs" / f"{container_name}.log.gz"
+
+def archive_container_logs(container, archive_path):
+    archive_path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(archive_path, "wb") as file:
+        file.write(container.logs(stdout=True, stderr=True, timestamps=True))
+    return archive_path.stat().st_size
+
+def archive_and_remove_container(client, container_name, image, results_dir=None):
+    try:
+        container = client.containers.get(container_name)
+    except:
+        logger.error(f"container[{container_name}] is already gone, no logs archived")
+        return
+    try:
+        archive_container_logs(container, get_log_archive_path(container.name, image, results_dir))
+    except:
+        logger.exception(f"archiving logs of container[{container_name}] failed")
+        # keep the container, it is reaped (and archived again) at the next start
+        return
+    try:
+        container.remove(force=True)
+    except:
+        logger.error(f"removing container[{container_name}] failed")
+
+def reap_containers(client, label=CONTAINER_LABEL, names=(), min_age=MIN_CONTAINER_AGE):
+    # stopped containers of earlier runs: the given ones (e.g. checkpoint leftovers) and those stopped long ago
+    # running ones and recently stopped ones may belong to another scanywhere instance
+    count, size = 0, 0
+    for info in client.api.containers(all=True, size=True, filters={"label": label, "status": ["exited", "created"]}):
+        container = client.containers.get(info["Id"])
+        if container.name not in names and get_container_age(container) < min_age:
+            continue
+        try:
+            archive_container_logs(container, get_log_archive_path(container.name, get_container_image(container)))
+            container.remove(force=True)
+        except:
+            logger.error(f"archiving logs of container[{container.name}] failed")
+            continue
+        count += 1
+        size += info.get("SizeRw") or 0
+    return count, size
+
+def reap_networks(client, names, label=CONTAINER_LABEL):
+    # only the given networks (created by an earlier run of this campaign), networks of running instances have no container either
+    count = 0
+    for name in names:
+        try:
+            network = client.networks.get(name)
+        except:
+            continue
+        if label not in (network.attrs.get("Labels") or {}):
+            logger.warning(f"network {name} is not labeled {label}, keep it")
+            continue
+        network.reload()
+        if not network.attrs.get("Containers"):
+            try:
+                network.remove()
+                count += 1
+            except:
+                logger.error(f"removing network {name} failed")
+    return count
+
+def reap_temp_configs(client, label=CONTAINER_LABEL, path=PATH_TEMP_CONFIGS, min_age=10*60):
+    # configs that are still referenced by a running gluetun container (or were just written) are kept
+    in_use = set()
+    for container in client.containers.list(filters={"label": label}):
+        for variable in container.attrs.get("Config", {}).get("Env") or []:
+            if variable.startswith("OPENVPN_CUSTOM_CONFIG="):
+                in_use.add(os.path.basename(variable.split("=", 1)[1]))
+    count, size = 0, 0
+    for config in Path(path).glob("*.conf"):
+        if UUID_PATTERN.match(config.stem) and config.name not in in_use and time.time() - config.stat().st_mtime > min_age:
+            size += config.stat().st_size
+            config.unlink()
+            count += 1
+    return count, size
+
+def collect_garbage(client, label=CONTAINER_LABEL, containers=(), networks=(), min_age=MIN_CONTAINER_AGE):
+    # containers/networks: names known to be leftovers of this campaign (e.g. from its checkpoint)
+    containers, space = reap_containers(client, label, containers, min_age)
+    networks = reap_networks(client, networks, label)
+    configs, config_size = reap_temp_configs(client, label)
+    report = {
+        "containers": containers,
+        "networks": networks,
+        "temp_configs": configs,
+        "bytes": space + config_size,
+    }
+    logger.info(f"garbage collection removed {containers} containers, {networks} networks and {configs} temp configs ({report['bytes'] / 1024 / 1024:.1f} MiB reclaimed)")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='remove leftovers (containers, networks, temp configs) of earlier scanywhere runs')
+    parser.add_argument('--label', default=CONTAINER_LABEL)
+    parser.add_argument('--min_age', type=int, default=MIN_CONTAINER_AGE // 60) # minutes since a container stopped
+    parser.add_argument('--networks', default="") # comma separated networks to remove (if labeled and unused)
+    args = parser.parse_args()
+
+    import docker
+    logging.basicConfig(level=logging.INFO)
+    collect_garbage(docker.from_env(), args.label, networks=[n for n in args.networks.split(",") if n], min_age=args.min_age*60)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+
+logger = logging.getLogger(__name__)
+
+PATH_COVERAGE = "coverage.json"
+FAILURE_HISTORY_LENGTH = 10
+# only failures to connect say something about the endpoint, e.g. measurement failures, provider-wide errors
+# (fatal, e.g. AUTH_FAILED) and expired leases are recorded without moving the endpoint towards its backoff
+BACKOFF_REASONS = ("connect",)
+
+
+def get_endpoint_id(endpoint):
+    return "|".join(endpoint.get(k) or "" for k in ("country", "region", "ip"))
+
+def parse_endpoint_id(endpoint_id):
+    country, region, ip = (endpoint_id.split("|") + ["", "", ""])[:3]
+    return {"country": country or None, "region": region or None, "ip": ip or None}
+
+
+class CoverageScheduler():
+    '''Pick the least covered viable endpoint (country first, then region, then ip).
+
+    Successful runs and failures are counted per provider/country/region/ip and
+    persisted to a json file. Endpoints that are currently handed out to a worker
+    count as covered, so parallel workers spread over different endpoints.
+    Endpoints failing to connect (BACKOFF_REASONS) max_consecutive_failures
+    times in a row are put into an exponential backoff (backoff_base seconds, doubled with every further failure
+    up to backoff_max) and skipped meanwhile (unless no other endpoint is left).
+    With global_countries, countries covered by any provider count as covered,
+    so several providers spread over as many distinct countries as possible.
+    '''
+
+    def __init__(self, path=PATH_COVERAGE, max_consecutive_failures=2, backoff_base=5*60, backoff_max=24*60*60, global_countries=False):
+        self.path = path
+        self.global_countries = global_countries
+        self.max_consecutive_failures = max_consecutive_failures
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.totals = dict()
+        self.pending = dict()
+        self.load()
+
+    @staticmethod
+    def get_keys(provider, endpoint):
+        country, region, ip = endpoint.get('country'), endpoint.get('region'), endpoint.get('ip')
+        return [(provider, country), (provider, country, region), (provider, country, region, ip)]
+
+    def get_select_keys(self, provider, endpoint):
+        keys = self.get_keys(provider, endpoint)
+        if self.global_countries:
+            # all providers combined
+            keys = [("*", endpoint.get('country'))] + keys
+        return keys
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                for entry in json.load(file).get('entries', []):
+                    key = (entry['provider'], entry['country'], entry['region'], entry['ip'])
+                    self.entries[key] = entry
+                    for k in [("*", entry['country'])] + self.get_keys(entry['provider'], entry)[:2]:
+                        self.totals[k] = self.totals.get(k, 0) + entry['successes']
+            logger.info(f"loaded coverage of {len(self.entries)} endpoints from {self.path}")
+        except FileNotFoundError:
+            pass
+        except:
+            logger.error(f"error reading coverage file {self.path}, starting with empty coverage")
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({'entries': list(self.entries.values())}, file)
+        os.replace(tmp_path, self.path)
+
+    def get_count(self, key):
+        if len(key) == 4:
+            count = self.entries.get(key, {}).get('successes', 0)
+        else:
+            count = self.totals.get(key, 0)
+        return count + self.pending.get(key, 0)
+
+    def get_backoff(self, entry):
+        failures = entry['consecutive_failures'] - self.max_consecutive_failures
+        if failures < 0:
+            return 0
+        return min(self.backoff_max, self.backoff_base * 2 ** failures)
+
+    def is_viable(self, provider, endpoint, now):
+        entry = self.entries.get(self.get_keys(provider, endpoint)[-1])
+        if not entry or entry['consecutive_failures'] < self.max_consecutive_failures:
+            return True
+        return now - entry['last_failure'] > self.get_backoff(entry)
+
+    def is_backed_off(self, provider, endpoint):
+        with self.lock:
+            return not self.is_viable(provider, endpoint, time.time())
+
+    def select(self, provider, candidates):
+        with self.lock:
+            now = time.time()
+            viable = [c for c in candidates if self.is_viable(provider, c, now)] or candidates
+            endpoint = min(viable, key=lambda c: ([self.get_count(k) for k in self.get_select_keys(provider, c)], random.random()))
+            for k in self.get_select_keys(provider, endpoint):
+                self.pending[k] = self.pending.get(k, 0) + 1
+            return endpoint
+
+    def get_least_covered_count(self, provider, candidates):
+        # coverage of the least covered viable candidate (used to pick the provider to measure next)
+        with self.lock:
+            now = time.time()
+            viable = [c for c in candidates if self.is_viable(provider, c, now)] or candidates
+            return min(self.get_count(self.get_select_keys(provider, c)[0]) for c in viable)
+
+    def record(self, provider, endpoint, success, reason=None):
+        with self.lock:
+            keys = self.get_keys(provider, endpoint)
+            for k in self.get_select_keys(provider, endpoint):
+                if self.pending.get(k, 0) > 0:
+                    self.pending[k] -= 1
+            entry = self.entries.setdefault(keys[-1], {
+                'provider': provider,
+                'country': endpoint.get('country'),
+                'region': endpoint.get('region'),
+                'ip': endpoint.get('ip'),
+                'successes': 0,
+                'failures': 0,
+                'consecutive_failures': 0,
+                'last_success': None,
+                'last_failure': None,
+                'failure_history': [],
+            })
+            if success:
+                entry['successes'] += 1
+                entry['consecutive_failures'] = 0
+                entry['last_success'] = time.time()
+                for k in [("*", endpoint.get('country'))] + keys[:2]:
+                    self.totals[k] = self.totals.get(k, 0) + 1
+            else:
+                entry['failures'] += 1
+                if reason in BACKOFF_REASONS:
+                    entry['consecutive_failures'] += 1
+                else:
+                    logger.info(f"{provider} endpoint {get_endpoint_id(endpoint)} failed ({reason}), not counted towards its backoff")
+                entry['last_failure'] = time.time()
+                entry['failure_history'] = (entry['failure_history'] + [{'time': entry['last_failure'], 'reason': reason}])[-FAILURE_HISTORY_LENGTH:]
+            self.save()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='print measured coverage per provider and country')
+    parser.add_argument('--path', default=PATH_COVERAGE)
+    args = parser.parse_args()
+
+    scheduler = CoverageScheduler(args.path)
+    countries = dict()
+    for entry in scheduler.entries.values():
+        counts = countries.setdefault((entry['provider'], entry['country']), [0, 0])
+        counts[0] += entry['successes']
+        counts[1] += entry['failures']
+    for (provider, country), (successes, failures) in sorted(countries.items(), key=lambda x: str(x[0])):
+        print(f"{provider:<25} {str(country):<30} {successes:>6} successful {failures:>6} failed")
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CONTAINER_LABEL = "scanywhere"
+
+
+class ContainerEventWatcher():
+    '''Follow the docker event stream and remember which (labeled) containers exited.
+
+    A single streaming connection replaces per-container status polling, so the
+    daemon sees O(1) requests per container no matter how many tunnels are running.
+    '''
+
+    def __init__(self, client, label=CONTAINER_LABEL, retention=60*60):
+        self.client = client
+        self.label = label
+        self.retention = retention
+        self.exited = dict()
+        self.exit_codes = dict()
+        self.exit_times = dict()
+        self.lock = threading.Lock()
+        # replay events from one second earlier in case a container dies while we connect
+        self.since = int(time.time()) - 1
+        self.thread = threading.Thread(target=self.follow_events, name="docker-events", daemon=True)
+        self.thread.start()
+
+    def get_event(self, container_name):
+        with self.lock:
+            return self.exited.setdefault(container_name, threading.Event())
+
+    def follow_events(self):
+        filters = {"type": "container", "event": ["die"], "label": [self.label]}
+        while True:
+            try:
+                for event in self.client.events(decode=True, since=self.since, filters=filters):
+                    self.since = event.get("time", self.since)
+                    attributes = event.get("Actor", {}).get("Attributes", {})
+                    container_name = attributes.get("name")
+                    if not container_name:
+                        continue
+                    with self.lock:
+                        self.exit_codes[container_name] = int(attributes.get("exitCode", -1))
+                        self.exit_times[container_name] = time.time()
+                    self.get_event(container_name).set()
+                    self.prune()
+            except:
+                logger.error("docker event stream interrupted, reconnecting...")
+                time.sleep(1)
+
+    def prune(self):
+        # drop exits nobody asked for (e.g. died after they were forgotten)
+        cutoff = time.time() - self.retention
+        with self.lock:
+            for container_name, exit_time in list(self.exit_times.items()):
+                if exit_time < cutoff:
+                    self.exited.pop(container_name, None)
+                    self.exit_codes.pop(container_name, None)
+                    self.exit_times.pop(container_name, None)
+
+    def wait(self, container_name, timeout=None):
+        return self.get_event(container_name).wait(timeout)
+
+    def has_exited(self, container_name):
+        return self.get_event(container_name).is_set()
+
+    def get_exit_code(self, container_name):
+        with self.lock:
+            return self.exit_codes.get(container_name)
+
+    def forget(self, container_name):
+        with self.lock:
+            self.exited.pop(container_name, None)
+            self.exit_codes.pop(container_name, None)
+            self.exit_times.pop(container_name, None)
+
+
+if __name__ == '__main__':
+    import docker
+    logging.basicConfig(level=logging.INFO)
+    watcher = ContainerEventWatcher(docker.from_env())
+    while True:
+        time.sleep(5)
+        logger.info(f"exited containers: {watcher.exit_codes}")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import fcntl
+import time
+import logging
+import argparse
+import threading
+
+logger = logging.getLogger(__name__)
+
+PATH_EC2_CACHE = "ec2_cache.json"
+# discovery results hardly change, an entry is looked up again after a day
+DEFAULT_TTL = 24*60*60
+
+
+class EC2Cache():
+    '''On-disk cache of slow EC2 discovery calls, keyed by account and region.
+
+    Holds e.g. the chosen instance type, AMI ids, the VPC/security group/subnet
+    ids and the region list. Entries are refreshed lazily: get_or_refresh only
+    calls refresh if the entry is missing or older than its ttl. Entries that
+    turn out to be stale earlier (e.g. a deleted VPC) are dropped via invalidate.
+    Several processes may share the file, every save merges their entries in.
+    '''
+
+    def __init__(self, path=PATH_EC2_CACHE, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.load()
+
+    @staticmethod
+    def get_scope(account, region):
+        return f"{account or '*'}|{region or '*'}"
+
+    def load(self):
+        self.entries = self.read()
+
+    def read(self):
+        try:
+            with open(self.path) as file:
+                return json.load(file).get('entries', {})
+        except FileNotFoundError:
+            pass
+        except:
+            logger.error(f"error reading ec2 cache {self.path}, starting with an empty cache")
+        return dict()
+
+    def save(self, removed=()):
+        # caller holds the lock, the file lock keeps other processes from writing in between
+        with open(f"{self.path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # entries written by other processes meanwhile, the newer one wins
+            for scope, entries in self.read().items():
+                for key, entry in entries.items():
+                    current = self.entries.setdefault(scope, {}).get(key)
+                    if (scope, key) not in removed and (current is None or current['time'] < entry['time']):
+                        self.entries[scope][key] = entry
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump({'entries': self.entries}, file)
+            os.replace(tmp_path, self.path)
+
+    def get(self, account, region, key, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            entry = self.entries.get(self.get_scope(account, region), {}).get(key)
+        if entry and time.time() - entry['time'] < ttl:
+            return entry['value']
+        return None
+
+    def set(self, account, region, key, value):
+        with self.lock:
+            self.entries.setdefault(self.get_scope(account, region), {})[key] = {'value': value, 'time': time.time()}
+            self.save()
+
+    def get_or_refresh(self, account, region, key, refresh, ttl=None):
+        value = self.get(account, region, key, ttl)
+        if value is None:
+            value = refresh()
+            if value is not None:
+                self.set(account, region, key, value)
+        return value
+
+    def invalidate(self, account, region, keys=None):
+        with self.lock:
+            scope = self.get_scope(account, region)
+            entries = self.entries.get(scope, {})
+            keys = list(entries) if keys is None else keys
+            for key in keys:
+                entries.pop(key, None)
+            self.save(removed={(scope, key) for key in keys})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='print (or clear) the cached ec2 discovery results')
+    parser.add_argument('--path', default=PATH_EC2_CACHE)
+    parser.add_argument('--clear', action='store_true')
+    args = parser.parse_args()
+
+    if args.clear:
+        os.remove(args.path)
+    else:
+        cache = EC2Cache(args.path)
+        for scope, entries in sorted(cache.entries.items()):
+            for key, entry in sorted(entries.items()):
+                value = json.dumps(entry['value'])
+                print(f"{scope:<40} {key:<40} {value[:60]:<60} age {(time.time() - entry['time']) / 60:>8.1f} min")
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import boto3
+from botocore.exceptions import ClientError
 import time
+import requests
 import logging
 from urllib.parse import urlparse
 
@@ -11,6 +13,9 @@ from contextlib import closing
 
 import os
 import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 #wg
 from base64 import urlsafe_b64encode
@@ -18,6 +23,12 @@ import codecs
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 from cryptography.hazmat.primitives import serialization
 
+try:
+    from utils.ec2_cache import EC2Cache
+except ModuleNotFoundError:
+    # run as script (python utils/ec2_manager.py)
+    from ec2_cache import EC2Cache
+
 logger = logging.getLogger(__name__)
 
 PATH_CREDENTIALS = "credentials.json"
@@ -29,6 +40,20 @@ VPC_NAME="VPC-EPHEMERAL-WG"
 SECURITY_GROUP_NAME="SG-EPHEMERAL-WG"
 SUBNET_NAME="SUBNET-EPHEMERAL-WG"
 PORT_WG=51820
+# the user data serves its setup times on this port once wireguard is up
+PORT_BEACON=51821
+IMAGE_NAME_DEBIAN="debian-12-amd64-20240429-1732"
+# baked from IMAGE_NAME_DEBIAN with wireguard and the deadman switch, bump the version when the bake script changes
+IMAGE_NAME_WG="scanywhere-wg-1"
+# error codes (resp. their prefix) of launches with stale cached ids, and the cache entries to look up again
+STALE_ID_ERRORS = {
+    "InvalidGroup.NotFound": ["security_group", "beacon_ingress"],
+    "InvalidSubnetID.NotFound": ["security_group", "beacon_ingress"],
+    "InvalidAMIID": ["wg_image_id", f"image_id:{IMAGE_NAME_DEBIAN}"],
+}
+
+ec2_cache = None
+ec2_cache_lock = threading.Lock()
 
 
 def is_port_open(host, port):
@@ -41,6 +66,17 @@ def is_port_open(host, port):
             #print("port closed")
             return False
 
+def get_stale_cache_keys(error):
+    code = error.response.get('Error', {}).get('Code', "")
+    return next((keys for prefix, keys in STALE_ID_ERRORS.items() if code == prefix or code.startswith(f"{prefix}.")), None)
+
+def get_ec2_cache():
+    global ec2_cache
+    with ec2_cache_lock:
+        if ec2_cache is None:
+            ec2_cache = EC2Cache()
+        return ec2_cache
+
 
 class EC2Manager():
     SCRIPT_HEADER = '''#!/bin/bash
@@ -49,7 +85,7 @@ class EC2Manager():
     
     @staticmethod
     def get_available_regions():
-        return boto3.session.Session().get_available_regions('ec2')
+        return get_ec2_cache().get_or_refresh(None, None, "regions", lambda: boto3.session.Session().get_available_regions('ec2'))
 
     def __init__(self, id=None, key=None, region=None): #region='eu-central-1'):
         # read public key
@@ -67,19 +103,24 @@ class EC2Manager():
                 json_dict = json.load(jsonfile)
                 id = json_dict.get('EC2_ID')  
                 key = json_dict.get('EC2_KEY')
-        self.ec2r = boto3.resource(
+        # own session, the default session must not be shared between threads (see EC2Fleet)
+        session = boto3.session.Session()
+        self.ec2r = session.resource(
             'ec2',
             aws_access_key_id=id,
             aws_secret_access_key=key,
             region_name=self.region
         )
-        self.ec2c = boto3.client(
+        self.ec2c = session.client(
             'ec2',
             aws_access_key_id=id,
             aws_secret_access_key=key,
             region_name=self.region
         )
         self.instance = None
+        # cache entries are per account (access key id) and region
+        self.account = id
+        self.cache = get_ec2_cache()
 
     def get_all_instance_types(self):
         # https://stackoverflow.com/questions/33120348/boto3-aws-api-listing-available-instance-types
@@ -155,6 +196,13 @@ class EC2Manager():
             'IpRanges': ip_ranges,
             'Ipv6Ranges': ip_v6_ranges
         },
+        {  
+            'IpProtocol': 'TCP',
+            'FromPort': PORT_BEACON,
+            'ToPort': PORT_BEACON,
+            'IpRanges': ip_ranges,
+            'Ipv6Ranges': ip_v6_ranges
+        },
         ]
         sg.authorize_ingress(IpPermissions=permissions)    
         sg.create_tags(Tags=[{"Key": "Name", "Value": SECURITY_GROUP_NAME}])
@@ -164,11 +212,87 @@ class EC2Manager():
         images = self.ec2r.images.filter(Filters=[{"Name": "name", "Values": [image_name]}])
         image = next((x for x in images), None)
         return image.id
-    
-    def start_instance_startup_script(self, startup_script):
-        security_group_id, subnet_id = self.prepare_security_group()
-        instance_type = self.get_apropriate_instance_types()[0].get('InstanceType')
-        image_id = self.get_image_id('debian-12-amd64-20240429-1732')
+
+    def get_cached_instance_type(self):
+        return self.cache.get_or_refresh(self.account, self.region, "instance_type", lambda: self.get_apropriate_instance_types()[0].get('InstanceType'))
+
+    def get_cached_image_id(self, image_name):
+        return self.cache.get_or_refresh(self.account, self.region, f"image_id:{image_name}", lambda: self.get_image_id(image_name))
+
+    def get_cached_security_group(self):
+        security_group_id, subnet_id = self.cache.get_or_refresh(self.account, self.region, "security_group", lambda: list(self.prepare_security_group()))
+        # security groups created before the beacon existed
+        self.cache.get_or_refresh(self.account, self.region, "beacon_ingress", lambda: self.allow_beacon(security_group_id))
+        return security_group_id, subnet_id
+
+    def allow_beacon(self, security_group_id):
+        try:
+            self.ec2c.authorize_security_group_ingress(GroupId=security_group_id, IpPermissions=[{
+                'IpProtocol': 'TCP',
+                'FromPort': PORT_BEACON,
+                'ToPort': PORT_BEACON,
+                'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
+                'Ipv6Ranges': [{'CidrIpv6': '::/0'}]
+            }])
+        except Exception as e:
+            if 'InvalidPermission.Duplicate' not in str(e):
+                raise
+        return True
+
+    def find_baked_image_id(self):
+        images = self.ec2r.images.filter(Owners=['self'], Filters=[{"Name": "name", "Values": [IMAGE_NAME_WG]}, {"Name": "state", "Values": ["available"]}])
+        image = next((x for x in images), None)
+        return image.id if image else ""
+
+    def get_baked_image_id(self):
+        # "" (cached as well) if the region has no baked image
+        return self.cache.get_or_refresh(self.account, self.region, "wg_image_id", self.find_baked_image_id)
+
+    def bake_image_wg(self):
+        # boots the base image with the bake script, which powers the instance off once done; the stopped instance becomes the image
+        image_id = self.find_baked_image_id()
+        if image_id:
+            logger.info(f"image {IMAGE_NAME_WG} already exists in region {self.region}: {image_id}")
+        else:
+            self.create_instance(EC2Manager.get_wg_bake_command(), shutdown_behavior='stop')
+            try:
+                logger.info(f"wait until instance {self.instance.id} in region {self.region} is baked")
+                self.instance.wait_until_stopped(WaiterConfig={'Delay': 15, 'MaxAttempts': 80})
+                image = self.instance.create_image(Name=IMAGE_NAME_WG, Description="scanywhere wireguard server (wireguard and deadman switch preinstalled)")
+                self.ec2c.get_waiter('image_available').wait(ImageIds=[image.id], WaiterConfig={'Delay': 15, 'MaxAttempts': 80})
+                image_id = image.id
+            finally:
+                # a stopped instance is not shut down by the deadman switch, also terminate it if baking failed
+                self.instance.terminate()
+            logger.info(f"baked image {IMAGE_NAME_WG} in region {self.region}: {image_id}")
+        self.cache.set(self.account, self.region, "wg_image_id", image_id)
+        return image_id
+
+    def start_instance_startup_script(self, startup_script, image_id=None):
+        self.timings = {'time_launch': time.time()}
+        try:
+            self.create_instance(startup_script, image_id)
+        except ClientError as e:
+            # cached ids may be stale (e.g. the vpc was deleted), look them up once more
+            keys = get_stale_cache_keys(e)
+            if keys is None:
+                raise
+            self.cache.invalidate(self.account, self.region, keys)
+            if image_id and "wg_image_id" in keys:
+                # the startup script is made for the baked image, the next launch looks it up again
+                raise
+            logger.warning(f"launching instance in region {self.region} failed ({e.response['Error']['Code']}), retry without cached ids")
+            self.create_instance(startup_script, image_id)
+        logger.info(f"wait until instance {self.instance.id} in region {self.region} is up and running")
+        self.instance.wait_until_running()
+        self.timings['time_running'] = time.time()
+        self.instance.reload() #refresh info, to get public ip addr
+        logger.info(f"instance running, ip addresses are {*self.get_ip(),}")
+
+    def create_instance(self, startup_script, image_id=None, shutdown_behavior='terminate'):
+        security_group_id, subnet_id = self.get_cached_security_group()
+        instance_type = self.get_cached_instance_type()
+        image_id = image_id or self.get_cached_image_id(IMAGE_NAME_DEBIAN)
         instance = self.ec2r.create_instances(
             ImageId=image_id, #'ami-0b0c5a84b89c4bf99', #'ami-07151644aeb34558a',
             MinCount=1,
@@ -177,14 +301,10 @@ class EC2Manager():
             SecurityGroupIds=[security_group_id],
             SubnetId=subnet_id,
             UserData=startup_script,
-            InstanceInitiatedShutdownBehavior='terminate'
+            InstanceInitiatedShutdownBehavior=shutdown_behavior
             #KeyName='aws_xps'
         )
         self.instance = instance[0]
-        logger.info(f"wait until instance {self.instance.id} in region {self.region} is up and running")
-        self.instance.wait_until_running()
-        self.instance.reload() #refresh info, to get public ip addr
-        logger.info(f"instance running, ip addresses are {*self.get_ip(),}")
 
     def start_instance_port_forward(self, port_forwards):
         startup_script = EC2Manager.SCRIPT_HEADER
@@ -194,11 +314,48 @@ class EC2Manager():
 
     def start_instance_wg(self):
         server_config_file, client_config_dict = EC2Manager.wg_genconfig()
-        startup_script = EC2Manager.get_wg_setup_command(server_config_file, self.ssh_pubkey)
-        self.start_instance_startup_script(startup_script)
+        image_id = self.get_baked_image_id()
+        if image_id:
+            # everything is installed, only the keys are injected
+            startup_script = EC2Manager.get_wg_boot_command(server_config_file, self.ssh_pubkey)
+        else:
+            startup_script = EC2Manager.get_wg_setup_command(server_config_file, self.ssh_pubkey)
+        self.start_instance_startup_script(startup_script, image_id)
         client_config_dict['VPN_ENDPOINT_IP'] = self.get_ip()[0]
+        # running is not listening yet, the user data still sets up wireguard
+        self.wait_for_beacon()
         return client_config_dict
 
+    def wait_for_beacon(self, maxwait=5*60, sleeptime=2):
+        ip = self.get_ip()[0]
+        time_start = time.time()
+        while True:
+            try:
+                beacon = requests.get(f"http://{ip}:{PORT_BEACON}/ready.json", timeout=5).json()
+                break
+            except:
+                if time.time() - time_start > maxwait:
+                    # gluetun retries on its own, like before the beacon existed
+                    logger.warning(f"no beacon of instance {self.instance.id} in region {self.region} after {maxwait}s, continue anyway")
+                    return None
+                time.sleep(sleeptime)
+        self.timings |= {'time_ready': time.time()} | beacon
+        logger.info(f"instance in region {self.region} ready after {self.timings['time_ready'] - self.timings['time_launch']:.1f}s ({self.get_setup_phases()})")
+        return beacon
+
+    def get_setup_phases(self):
+        # launch: until ec2 reports running, boot: until the user data starts, setup: until wg0 is up, beacon: until it was seen
+        # boot and beacon compare the clock of the instance with ours
+        t = getattr(self, "timings", {})
+        if 'time_ready' not in t:
+            return {}
+        return {
+            "ec2_launch": round(t['time_running'] - t['time_launch'], 3),
+            "ec2_boot": round(t['setup_start'] - t['time_running'], 3),
+            "ec2_setup": round(t['wg_up'] - t['setup_start'], 3),
+            "ec2_beacon": round(t['time_ready'] - t['wg_up'], 3),
+        }
+
     def wait_for_portforward(self, port):
         ip = self.get_ip()[0]
         while(not is_port_open(ip, port)):
@@ -287,6 +444,7 @@ class EC2Manager():
     @staticmethod
     def get_wg_setup_command(server_config_file, pubkey):
         script_setup = f'''#!/bin/bash
+        time_setup_start=$(date +%s.%N)
 
         # add pubkey for troubleshooting via ssh
         mkdir -p /home/admin/.ssh/
@@ -305,6 +463,7 @@ class EC2Manager():
         mkdir -p /etc/wireguard/
         printf "{server_config_file}" | tee /etc/wireguard/wg0.conf
         wg-quick up wg0
+        {EC2Manager.get_beacon_command()}
 
         curl {URL_DEADMAN_SWITCH_SHELLSCRIPT} > /usr/bin/deadman_switch.sh
         sed -i -e 's/\r$//' /usr/bin/deadman_switch.sh
@@ -317,9 +476,276 @@ class EC2Manager():
         '''
         return script_setup
 
+    @staticmethod
+    def get_wg_bake_command():
+        script_bake = f'''#!/bin/bash
+
+        # install wireguard
+        apt update
+        apt install -y wireguard curl
+
+        # enable forwarding at every boot
+        printf "net.ipv4.ip_forward=1\nnet.ipv6.conf.all.forwarding=1\n" | tee /etc/sysctl.d/99-wireguard.conf
+
+        # deadman switch starts at every boot
+        curl {URL_DEADMAN_SWITCH_SHELLSCRIPT} > /usr/bin/deadman_switch.sh
+        sed -i -e 's/\r$//' /usr/bin/deadman_switch.sh
+        chmod +x /usr/bin/deadman_switch.sh
+
+        curl {URL_DEADMAN_SWITCH_SERVICE} > /lib/systemd/system/deadman_switch.service
+        systemctl daemon-reload
+        systemctl enable deadman_switch.service
+
+        # instances of the image run their own user data again
+        cloud-init clean --logs
+        shutdown -P now
+        '''
+        return script_bake
+
+    @staticmethod
+    def get_wg_boot_command(server_config_file, pubkey):
+        script_boot = f'''#!/bin/bash
+        time_setup_start=$(date +%s.%N)
+
+        # add pubkey for troubleshooting via ssh
+        mkdir -p /home/admin/.ssh/
+        printf "{pubkey}\n" | tee -a /home/admin/.ssh/authorized_keys
+
+        sysctl -w net.ipv6.conf.$(ip route list | grep default | awk '{{print $5}}').accept_ra=2
+
+        # setup wireguard config
+        mkdir -p /etc/wireguard/
+        printf "{server_config_file}" | tee /etc/wireguard/wg0.conf
+        wg-quick up wg0
+        {EC2Manager.get_beacon_command()}
+        '''
+        return script_boot
+
+    @staticmethod
+    def get_beacon_command():
+        # setup times (epoch seconds of the instance) served via http, see wait_for_beacon
+        script_beacon = f'''
+        mkdir -p /var/lib/scanywhere/beacon
+        printf '{{"boot": %s, "setup_start": %s, "wg_up": %s}}' "$(awk '/btime/ {{print $2}}' /proc/stat)" "$time_setup_start" "$(date +%s.%N)" > /var/lib/scanywhere/beacon/ready.json
+        systemd-run --unit=scanywhere-beacon python3 -m http.server {PORT_BEACON} --directory /var/lib/scanywhere/beacon
+        '''
+        return script_beacon
+
+
+
+class EC2Fleet():
+    '''WireGuard instances in several regions, launched concurrently.
+
+    launch() starts one instance per given region in the background and
+    as_ready() yields (region, manager, client config) as soon as an instance
+    is running, so the first regions can be used while the others still boot.
+    The orchestrator keeps size instances launching ahead via get_ready_regions()
+    and take()s the instance of the region it selected. Instances that are not
+    taken within max_idle seconds after EC2 reported them running are terminated,
+    before their deadman switch shuts them down (5 minutes after boot without a
+    handshake) while an iteration is about to use them.
+    '''
+
+    def __init__(self, size=4, max_idle=3*60, max_workers=32):
+        self.size = size
+        self.max_idle = max_idle
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="ec2-fleet")
+        self.changed = threading.Condition()
+        self.launching = dict()
+        self.launched = dict()
+        self.ready = list()
+
+    def launch_region(self, region):
+        try:
+            manager = EC2Manager(region=region)
+            client_config_dict = manager.start_instance_wg()
+            instance = {'region': region, 'manager': manager, 'config': client_config_dict}
+            with self.changed:
+                self.ready.append(instance)
+            return instance
+        except:
+            logger.exception(f"launching ec2 instance in region {region} failed")
+            raise
+        finally:
+            with self.changed:
+                self.launching[region] -= 1
+                self.changed.notify_all()
+
+    def launch(self, regions):
+        futures = list()
+        with self.changed:
+            for region in regions:
+                self.launching[region] = self.launching.get(region, 0) + 1
+                self.launched[region] = self.launched.get(region, 0) + 1
+                futures.append(self.executor.submit(self.launch_region, region))
+        return futures
+
+    def as_ready(self, regions):
+        for future in as_completed(self.launch(regions)):
+            if future.exception() is None and self.remove(future.result()):
+                instance = future.result()
+                yield instance['region'], instance['manager'], instance['config']
+
+    def remove(self, instance):
+        with self.changed:
+            if instance in self.ready:
+                self.ready.remove(instance)
+                return True
+        return False
+
+    def evict_idle(self):
+        # caller holds the lock
+        # the deadman switch counts from boot, not from the beacon
+        for instance in [i for i in self.ready if time.time() - i['manager'].timings['time_running'] > self.max_idle]:
+            logger.info(f"ec2 instance in region {instance['region']} was not used in time, terminate it")
+            self.ready.remove(instance)
+            self.executor.submit(instance['manager'].stop_instance)
+
+    def fill(self, regions):
+        # caller holds the lock, the least launched regions first so that all of them are covered over time
+        pending = sum(self.launching.values()) + len(self.ready)
+        busy = set(self.launching_regions()) | {i['region'] for i in self.ready}
+        candidates = sorted([r for r in dict.fromkeys(regions) if r not in busy], key=lambda r: self.launched.get(r, 0))
+        return candidates[:max(0, self.size - pending)]
+
+    def launching_regions(self):
+        return [r for r, count in self.launching.items() if count > 0]
+
+    def get_ready_regions(self, regions, wait=True):
+        # tops up the launches and waits until an instance of these regions is ready
+        # returns an empty list if none of them can get ready (e.g. all launches failed)
+        with self.changed:
+            self.evict_idle()
+            missing = self.fill(regions)
+        self.launch(missing)
+        with self.changed:
+            while True:
+                ready = list(dict.fromkeys(i['region'] for i in self.ready if i['region'] in regions))
+                if ready or not wait or not any(r in regions for r in self.launching_regions()):
+                    return ready
+                self.changed.wait(10)
+
+    def take(self, region):
+        # a ready instance of the region (waits while one is launching), None if there is none
+        with self.changed:
+            while True:
+                self.evict_idle()
+                instance = next((i for i in self.ready if i['region'] == region), None)
+                if instance:
+                    self.ready.remove(instance)
+                    return instance['manager'], instance['config']
+                if not self.launching.get(region):
+                    return None
+                self.changed.wait(10)
+
+    def stop(self):
+        # terminate the instances nobody took, launches in flight are left to their deadman switch
+        with self.changed:
+            instances, self.ready = self.ready, list()
+        for instance in instances:
+            instance['manager'].stop_instance()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class EC2LeasePool():
+    '''Running WireGuard instances that are reused by subsequent iterations.
+
+    An instance is leased by one iteration at a time (its client keys are
+    reused), and retired with stop_instance() after max_uses leases, after
+    max_age seconds or once a lease reports a broken tunnel. Released instances
+    that are not leased again within max_idle seconds are stopped as well,
+    before their deadman switch would do so (5 minutes after the last
+    handshake, which can be up to 2 minutes older than the release).
+    '''
+
+    def __init__(self, max_uses=10, max_age=30*60, max_idle=2*60, check_interval=15):
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = list()
+        self.leased = dict()
+        threading.Thread(target=self.evict_idle, args=(check_interval,), name="ec2-lease-pool", daemon=True).start()
+
+    def is_expired(self, instance):
+        return instance['uses'] >= self.max_uses or time.time() - instance['time_started'] > self.max_age
+
+    def acquire(self, region):
+        with self.lock:
+            instance = next((i for i in self.idle if i['region'] == region and not self.is_expired(i)), None)
+            if instance is None:
+                return None
+            self.idle.remove(instance)
+            instance['uses'] += 1
+            self.leased[instance['config']['VPN_ENDPOINT_IP']] = instance
+        logger.info(f"reuse ec2 instance in region {region} ({instance['uses']}. lease)")
+        return instance['manager'], instance['config']
+
+    def add(self, manager, client_config_dict):
+        # a freshly launched instance, leased by its first user
+        with self.lock:
+            self.leased[client_config_dict['VPN_ENDPOINT_IP']] = {
+                'region': manager.region,
+                'manager': manager,
+                'config': client_config_dict,
+                'uses': 1,
+                'time_started': time.time(),
+                'time_released': None,
+            }
+
+    def release(self, endpoint_ip, healthy=True):
+        with self.lock:
+            instance = self.leased.pop(endpoint_ip, None)
+            if instance is None:
+                return
+            retire = not healthy or self.is_expired(instance)
+            if not retire:
+                instance['time_released'] = time.time()
+                self.idle.append(instance)
+        if retire:
+            self.retire(instance)
+
+    def retire(self, instance):
+        logger.info(f"retire ec2 instance in region {instance['region']} after {instance['uses']} leases")
+        threading.Thread(target=instance['manager'].stop_instance, daemon=True).start()
+
+    def get_idle_regions(self, regions):
+        with self.lock:
+            return list(dict.fromkeys(i['region'] for i in self.idle if i['region'] in regions and not self.is_expired(i)))
+
+    def evict_idle(self, check_interval):
+        while True:
+            time.sleep(check_interval)
+            with self.lock:
+                evicted = [i for i in self.idle if self.is_expired(i) or time.time() - i['time_released'] > self.max_idle]
+                self.idle = [i for i in self.idle if i not in evicted]
+            for instance in evicted:
+                self.retire(instance)
+
+    def stop(self):
+        with self.lock:
+            instances = self.idle + list(self.leased.values())
+            self.idle, self.leased = list(), dict()
+        for instance in instances:
+            instance['manager'].stop_instance()
 
 
 if __name__ == '__main__':
-    manager = EC2Manager()
-    #instance.start_instance_startup_script("")
-    manager.start_instance_wg()
+    parser = argparse.ArgumentParser(description='start wireguard ec2 instances in several regions concurrently')
+    parser.add_argument('--regions') # comma separated (default: one random region)
+    parser.add_argument('--bake', action='store_true') # bake the wireguard image in these regions (default: all regions) instead
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.bake:
+        regions = args.regions.split(",") if args.regions else EC2Manager.get_available_regions()
+        with ThreadPoolExecutor(len(regions)) as executor:
+            for region, image_id in zip(regions, executor.map(lambda r: EC2Manager(region=r).bake_image_wg(), regions)):
+                print(f"{region}: {image_id}")
+    elif not args.regions:
+        manager = EC2Manager()
+        manager.start_instance_wg()
+    else:
+        fleet = EC2Fleet(max_workers=len(args.regions.split(",")))
+        for region, manager, client_config_dict in fleet.as_ready(args.regions.split(",")):
+            print(f"{region}: {json.dumps(client_config_dict)}")
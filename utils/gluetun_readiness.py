@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import re
+import json
+import bisect
+import time
+import logging
+import argparse
+import threading
+import statistics
+import requests
+try:
+    from utils.phase_timing import percentile
+except ModuleNotFoundError:
+    # run as script (python utils/gluetun_readiness.py)
+    from phase_timing import percentile
+
+logger = logging.getLogger(__name__)
+
+PATH_CONNECT_TIMES = "connect_times.jsonl"
+
+# e.g. "INFO [ip getter] Public IP address is 89.187.168.1 (Germany, Hesse, Frankfurt am Main)"
+PUBLIC_IP_PATTERN = re.compile(r"Public IP address is (\S+) \(([^,)]*)")
+
+# errors gluetun keeps retrying although they will never recover
+FATAL_PATTERNS = [
+    re.compile(r"AUTH_FAILED"),
+    re.compile(r"authentication failed", re.IGNORECASE),
+    re.compile(r"no server found", re.IGNORECASE),
+    re.compile(r"Options error"),
+    re.compile(r"Cannot resolve host address", re.IGNORECASE),
+]
+
+connect_times_lock = threading.Lock()
+
+
+class GluetunFatalError(Exception):
+    pass
+
+
+class GluetunReadinessDetector():
+    '''Wait until a gluetun container knows its public ip.
+
+    The container log is followed in a background thread: the "Public IP address"
+    line ends the wait immediately and known fatal errors fail fast. In between,
+    the control server is queried every sleeptime seconds as a fallback.
+    '''
+
+    def __init__(self, client, container_name, api_port, abort_event=None, sleeptime=1, maxwait=60*5):
+        self.client = client
+        self.container_name = container_name
+        self.api_port = api_port
+        self.abort_event = abort_event
+        self.sleeptime = sleeptime
+        self.maxwait = maxwait
+        self.result = None
+        self.error = None
+        self.changed = threading.Event()
+
+    def follow_logs(self):
+        try:
+            for line in self.client.api.logs(self.container_name, stream=True, follow=True):
+                line = line.decode(errors="replace")
+                match = PUBLIC_IP_PATTERN.search(line)
+                if match:
+                    self.result = (match.group(1), match.group(2))
+                    break
+                if any(p.search(line) for p in FATAL_PATTERNS):
+                    self.error = line.strip()
+                    break
+        except:
+            logger.debug(f"log stream of {self.container_name} interrupted")
+        # log stream also ends when the container stops
+        self.changed.set()
+
+    def query_public_ip(self):
+        try:
+            response = requests.get(f"http://localhost:{self.api_port}/v1/publicip/ip", timeout=5).json()
+            if response.get("public_ip"):
+                return response["public_ip"], response.get("country")
+        except:
+            pass
+        return None
+
+    def wait(self):
+        threading.Thread(target=self.follow_logs, name=f"logs-{self.container_name}", daemon=True).start()
+        time_start = time.time()
+        while True:
+            if self.error:
+                raise GluetunFatalError(self.error)
+            if self.result:
+                return self.result
+            if self.abort_event is not None and self.abort_event.is_set():
+                raise InterruptedError()
+            result = self.query_public_ip()
+            if result:
+                return result
+            if time.time() - time_start > self.maxwait:
+                raise TimeoutError()
+            if self.changed.is_set():
+                # log stream ended without a result, only poll from now on
+                time.sleep(self.sleeptime)
+            else:
+                self.changed.wait(self.sleeptime)
+
+
+class ConnectTimeouts():
+    '''Adaptive gluetun connect timeouts from the recorded time-to-ready.
+
+    The timeout of a provider/country/region is the p99 of its successful
+    connects plus margin seconds. Locations with less than min_samples fall back
+    to their country, then their provider and finally to the default timeout.
+    '''
+
+    def __init__(self, path=PATH_CONNECT_TIMES, margin=30, min_samples=20, default=60*5, maximum=60*5):
+        self.margin = margin
+        self.min_samples = min_samples
+        self.default = default
+        self.maximum = maximum
+        self.lock = threading.Lock()
+        self.samples = dict()
+        for record in read_connect_times(path):
+            self.add(record)
+
+    @staticmethod
+    def get_keys(record):
+        provider, country, region = record.get('provider'), record.get('country'), record.get('region')
+        return [(provider, country, region), (provider, country), (provider,)]
+
+    def add(self, record):
+        if record.get('outcome') != "ready":
+            return
+        with self.lock:
+            for key in self.get_keys(record):
+                bisect.insort(self.samples.setdefault(key, []), record['seconds'])
+
+    def get_median(self, record):
+        with self.lock:
+            for key in self.get_keys(record):
+                samples = self.samples.get(key, [])
+                if len(samples) >= self.min_samples:
+                    return percentile(samples, 50)
+        return None
+
+    def get_timeout(self, record):
+        with self.lock:
+            for key in self.get_keys(record):
+                samples = self.samples.get(key, [])
+                if len(samples) >= self.min_samples:
+                    return min(self.maximum, percentile(samples, 99) + self.margin)
+        return self.default
+
+
+def record_connect_time(record, path=PATH_CONNECT_TIMES):
+    with connect_times_lock:
+        with open(path, "a") as file:
+            file.write(json.dumps(record) + "\n")
+
+def read_connect_times(path=PATH_CONNECT_TIMES):
+    records = []
+    try:
+        with open(path) as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except:
+                    pass
+    except FileNotFoundError:
+        pass
+    return records
+
+def print_summary(records, group_by=("provider", "country")):
+    groups = dict()
+    for r in records:
+        groups.setdefault(tuple(r.get(k) for k in group_by), []).append(r)
+    print(f"{' / '.join(group_by):<50} {'runs':>6} {'ready':>6} {'median[s]':>10} {'max[s]':>8}")
+    for key, group in sorted(groups.items(), key=lambda x: str(x[0])):
+        ready = [r['seconds'] for r in group if r.get('outcome') == "ready"]
+        median = f"{statistics.median(ready):.1f}" if ready else "-"
+        maximum = f"{max(ready):.1f}" if ready else "-"
+        print(f"{' / '.join(str(k) for k in key):<50} {len(group):>6} {len(ready):>6} {median:>10} {maximum:>8}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='summarize gluetun time-to-ready')
+    parser.add_argument('--path', default=PATH_CONNECT_TIMES)
+    parser.add_argument('--group_by', default="provider,country")
+    args = parser.parse_args()
+    print_summary(read_connect_times(args.path), args.group_by.split(","))
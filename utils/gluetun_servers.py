@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+PATH_GLUETUN_SERVERS = "docker/gluetun/servers.json"
+
+
+def read_gluetun_servers(json_path=PATH_GLUETUN_SERVERS):
+  parsed = None
+  while True:
+    try:
+        with open(json_path) as file:
+            content = file.read()
+            parsed = json.loads(content)
+            if parsed:
+                return parsed
+            else:
+                logger.error("no content read from servers.json")
+    except:
+        logger.error("exception parsing gluetun servers.json")
+        time.sleep(5)
+
+def get_endpoints(server):
+    # one endpoint per server ip, so every exit ip can be targeted individually
+    return [{
+        "vpn": server.get('vpn', 'openvpn'),
+        "country": server.get('country'),
+        "region": server.get('region'),
+        "city": server.get('city'),
+        "hostname": server.get('hostname'),
+        "ip": ip,
+    } for ip in server.get('ips', [])]
+
+def build_provider_index(servers):
+    locations = dict()
+    endpoints = dict()
+    endpoints_by_country = dict()
+    for server in servers:
+        locations.setdefault(server.get('country'), dict()).setdefault(server.get('region'), []).append(server)
+        for endpoint in get_endpoints(server):
+            endpoints.setdefault(endpoint['vpn'], []).append(endpoint)
+            endpoints_by_country.setdefault(endpoint['vpn'], dict()).setdefault(endpoint['country'], []).append(endpoint)
+    countries = [d.get('country') for d in servers]
+    regions = [d.get('region') for d in servers]
+    return {
+        "servers": servers,
+        "locations": locations,
+        "countries": countries,
+        "regions": regions,
+        # de-duplicated once here instead of on every selection
+        "countries_normalized": list(dict.fromkeys(countries)),
+        "regions_normalized": list(dict.fromkeys(regions)),
+        # vpn type -> endpoints (resp. country -> endpoints)
+        "endpoints": endpoints,
+        "endpoints_by_country": endpoints_by_country,
+    }
+
+
+class GluetunServerIndex():
+    '''Index of the gluetun servers.json (provider -> country -> region -> servers).
+
+    The file is only parsed again when its mtime changes, so looking up a provider
+    costs a stat() call. Indices are replaced as a whole and never modified, which
+    allows concurrent workers to share them without locking.
+    '''
+
+    def __init__(self, json_path=PATH_GLUETUN_SERVERS):
+        self.json_path = json_path
+        self.mtime = None
+        self.providers = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.json_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self.providers is not None and mtime == self.mtime:
+            return self.providers
+        with self.lock:
+            if self.providers is not None and mtime == self.mtime:
+                return self.providers
+            try:
+                with open(self.json_path) as file:
+                    parsed = json.load(file)
+            except:
+                parsed = None
+            if not parsed:
+                if self.providers is not None:
+                    # e.g. gluetun is rewriting the file right now, keep the previous index
+                    logger.error("exception parsing gluetun servers.json, keep using the cached version")
+                    return self.providers
+                parsed = read_gluetun_servers(self.json_path)
+            logger.info(f"indexing {self.json_path}")
+            self.providers = {name: build_provider_index(provider.get('servers', [])) for name, provider in parsed.items() if isinstance(provider, dict)}
+            self.mtime = mtime
+            return self.providers
+
+    def get_provider(self, provider):
+        return self.refresh()[provider]
+
+
+server_indices = dict()
+server_indices_lock = threading.Lock()
+
+def get_server_index(json_path=PATH_GLUETUN_SERVERS):
+    with server_indices_lock:
+        return server_indices.setdefault(json_path, GluetunServerIndex(json_path))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    index = get_server_index()
+    for name, provider in index.refresh().items():
+        endpoints = sum(len(e) for e in provider['endpoints'].values())
+        print(f"{name}: {len(provider['servers'])} servers, {endpoints} endpoints, {len(provider['countries_normalized'])} countries, {len(provider['regions_normalized'])} regions")
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+import logging
+import argparse
+import concurrent.futures
+from docker.utils.build import tar, exclude_paths
+
+logger = logging.getLogger(__name__)
+
+LABEL_CONTEXT_HASH = "scanywhere.context-hash"
+
+# runtime data that lives next to the dockerfiles but is never part of an image
+DEFAULT_EXCLUDES = [
+    "results",
+    "**/__pycache__",
+    "**/*.pyc",
+]
+
+
+class UnknownImageError(Exception):
+    pass
+
+
+def read_dockerignore(path):
+    try:
+        with open(os.path.join(path, ".dockerignore")) as f:
+            return [line.strip() for line in f.read().splitlines() if line.strip() and not line.strip().startswith("#")]
+    except FileNotFoundError:
+        return []
+
+def get_excludes(path):
+    return DEFAULT_EXCLUDES + read_dockerignore(path)
+
+def get_context_hash(path, excludes):
+    # note: remote sources (e.g. ADD https://...) are not part of the hash, use force to rebuild them
+    digest = hashlib.sha256()
+    for relpath in sorted(exclude_paths(path, excludes)):
+        fullpath = os.path.join(path, relpath)
+        if not os.path.isfile(fullpath):
+            continue
+        digest.update(relpath.encode())
+        digest.update(oct(os.stat(fullpath).st_mode & 0o777).encode())
+        with open(fullpath, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def get_image_context_hash(client, tag):
+    try:
+        return (client.images.get(tag).labels or {}).get(LABEL_CONTEXT_HASH)
+    except:
+        return None
+
+def build_image(client, path, tag, force=False):
+    excludes = get_excludes(path)
+    context_hash = get_context_hash(path, excludes)
+    if not force and get_image_context_hash(client, tag) == context_hash:
+        logger.info(f"{tag} image is up to date ({context_hash[:12]}), skip build")
+        return False
+    logger.info(f"build {tag} container...")
+    with tar(path, exclude=excludes) as context:
+        client.images.build(fileobj=context, custom_context=True, tag=tag, labels={LABEL_CONTEXT_HASH: context_hash})
+    return True
+
+def build_images(client, images, force=False):
+    # images: dict of tag -> build context path, built in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(images))) as executor:
+        futures = {tag: executor.submit(build_image, client, path, tag, force) for tag, path in images.items()}
+    # raise the first build error (after all builds finished)
+    return {tag: future.result() for tag, future in futures.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build scanywhere images (skipped if their build context did not change)')
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args()
+
+    import docker
+    logging.basicConfig(level=logging.INFO)
+    build_images(docker.from_env(), {tag: f"docker/{tag}/" for tag in args.images}, args.force)
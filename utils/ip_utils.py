@@ -28,10 +28,13 @@ def allowed_gai_family():
 allowed_gai_family_orig = urllib3_cn.allowed_gai_family
 urllib3_cn.allowed_gai_family = allowed_gai_family
 
-def get_ip_info(url="https://wtfismyip.com/json", sleeptime=2, ip_field="YourFuckingIPAddress", country_field="YourFuckingCountryCode", maxwait=60*5, proxies=None):
+def get_ip_info(url="https://wtfismyip.com/json", sleeptime=2, ip_field="YourFuckingIPAddress", country_field="YourFuckingCountryCode", maxwait=60*5, proxies=None, abort_event=None):
+    # abort_event (threading.Event) allows to stop waiting immediately, e.g. when the vpn container died
     time_start = time.time()
     response = None
     while not response:
+        if abort_event is not None and abort_event.is_set():
+            raise InterruptedError()
         try:
             #print(f"requsting {url} ...")
             r = requests.get(url, timeout=30, proxies=proxies)
@@ -44,4 +47,7 @@ def get_ip_info(url="https://wtfismyip.com/json", sleeptime=2, ip_field="YourFuc
             response = None
             if time.time() - time_start > maxwait:
                 raise TimeoutError()
-            time.sleep(sleeptime)
\ No newline at end of file
+            if abort_event is not None:
+                abort_event.wait(sleeptime)
+            else:
+                time.sleep(sleeptime)
\ No newline at end of file
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import argparse
+import requests
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+PATH_JOB_QUEUE = "jobs.sqlite"
+# shared secret of coordinator and remote workers (optional)
+ENV_JOB_QUEUE_TOKEN = "SCANYWHERE_JOB_QUEUE_TOKEN"
+# the calls of a worker, served to workers on other hosts
+REMOTE_METHODS = ("lease", "renew", "complete")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    service TEXT,
+    provider TEXT,
+    selection TEXT,
+    status TEXT,
+    worker TEXT,
+    created REAL,
+    leased REAL,
+    lease_expires REAL,
+    finished REAL,
+    success INTEGER,
+    reason TEXT,
+    phases TEXT,
+    recorded INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, provider);
+CREATE TABLE IF NOT EXISTS device_limits (
+    provider TEXT PRIMARY KEY,
+    slots INTEGER
+);
+"""
+
+# a pending job whose provider has a free device slot (providers without limit always have one)
+SELECT_LEASABLE = """
+SELECT j.id FROM jobs j LEFT JOIN device_limits l ON l.provider = j.provider
+WHERE j.status = 'pending'
+  AND (l.slots IS NULL OR (SELECT COUNT(*) FROM jobs k WHERE k.status = 'leased' AND k.provider = j.provider) < l.slots)
+ORDER BY j.id LIMIT 1
+"""
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}-{threading.current_thread().name}"
+
+def to_job(row):
+    job = dict(row)
+    job['selection'] = json.loads(job['selection'] or "{}")
+    job['phases'] = json.loads(job['phases'] or "{}")
+    return job
+
+
+class JobQueue():
+    '''Sqlite backed job queue shared by one coordinator and any number of workers.
+
+    Workers on the host of the coordinator may open the database directly;
+    sqlite relies on file locks, which are not reliable on network file
+    systems, so workers on other hosts use a RemoteJobQueue instead.
+
+    The coordinator puts jobs (service and selected endpoint) and the device
+    limit per provider; a worker leases the oldest job whose provider has a free
+    device slot, renews the lease while running it and completes it with its
+    outcome and phase timings. Leases that are not renewed in time expire, so
+    the slot of a crashed worker is freed again. Status of a job:
+    pending -> leased -> done (resp. expired).
+    '''
+
+    def __init__(self, path=PATH_JOB_QUEUE, lease_seconds=10*60):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.local = threading.local()
+        self.connect().executescript(SCHEMA)
+
+    def connect(self):
+        # one connection per thread, transactions are explicit
+        if getattr(self.local, "conn", None) is None:
+            self.local.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self.local.conn.row_factory = sqlite3.Row
+        return self.local.conn
+
+    def set_device_limits(self, limits):
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM device_limits")
+        conn.executemany("INSERT INTO device_limits VALUES (?, ?)", [(p, s) for p, s in limits.items() if s])
+        conn.execute("COMMIT")
+
+    def put(self, service, provider, selection):
+        cursor = self.connect().execute("INSERT INTO jobs (service, provider, selection, status, created) VALUES (?, ?, ?, 'pending', ?)",
+                                        (service, provider, json.dumps(selection), time.time()))
+        return cursor.lastrowid
+
+    def count(self, status):
+        return self.connect().execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def expire_leases(self):
+        cursor = self.connect().execute("UPDATE jobs SET status = 'expired', finished = ? WHERE status = 'leased' AND lease_expires < ?",
+                                        (time.time(), time.time()))
+        return cursor.rowcount
+
+    def lease(self, worker):
+        conn = self.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("UPDATE jobs SET status = 'expired', finished = ? WHERE status = 'leased' AND lease_expires < ?", (now, now))
+            row = conn.execute(SELECT_LEASABLE).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("UPDATE jobs SET status = 'leased', worker = ?, leased = ?, lease_expires = ? WHERE id = ?",
+                         (worker, now, now + self.lease_seconds, row['id']))
+            job = conn.execute("SELECT * FROM jobs WHERE id = ?", (row['id'],)).fetchone()
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return to_job(job)
+
+    def renew(self, job_id, worker):
+        cursor = self.connect().execute("UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                                        (time.time() + self.lease_seconds, job_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, success, reason=None, phases=None):
+        # a job whose lease expired meanwhile stays expired
+        cursor = self.connect().execute("UPDATE jobs SET status = 'done', finished = ?, success = ?, reason = ?, phases = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                                        (time.time(), int(success), reason, json.dumps(phases or {}), job_id, worker))
+        return cursor.rowcount == 1
+
+    def collect_finished(self):
+        # finished jobs the coordinator did not record yet
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        jobs = [to_job(row) for row in conn.execute("SELECT * FROM jobs WHERE status IN ('done', 'expired') AND recorded = 0")]
+        conn.executemany("UPDATE jobs SET recorded = 1 WHERE id = ?", [(job['id'],) for job in jobs])
+        conn.execute("COMMIT")
+        return jobs
+
+    def cancel_pending(self):
+        # jobs of an earlier coordinator run, selected with a coverage state that is gone
+        return self.connect().execute("DELETE FROM jobs WHERE status = 'pending'").rowcount
+
+
+class JobQueueHandler(BaseHTTPRequestHandler):
+    # POST /<method> with the keyword arguments as json, replies {"result": ...}
+    def do_POST(self):
+        method = self.path.strip("/")
+        if self.server.token and self.headers.get("Authorization") != f"Bearer {self.server.token}":
+            return self.reply(403, {"error": "invalid token"})
+        if method not in REMOTE_METHODS:
+            return self.reply(404, {"error": f"unknown method {method}"})
+        try:
+            kwargs = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "{}")
+            result = getattr(self.server.job_queue, method)(**kwargs)
+        except:
+            logger.exception(f"job queue call {method} failed")
+            return self.reply(500, {"error": f"{method} failed"})
+        self.reply(200, {"result": result})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class JobQueueServer(ThreadingHTTPServer):
+    '''HTTP API of a job queue for workers on other hosts.
+
+    Serves the calls of a worker (lease, renew and complete) on top of the
+    sqlite queue of the coordinator. With a token, requests have to carry it as
+    bearer token; the API is plain HTTP, i.e., it belongs into a trusted network
+    (or behind a tunnel or TLS proxy).
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, job_queue, address, token=None):
+        self.job_queue = job_queue
+        self.token = token
+        super().__init__(address, JobQueueHandler)
+
+
+class RemoteJobQueue():
+    '''Worker side of a job queue that is served by a JobQueueServer.
+
+    Same calls as the JobQueue of a worker; errors (e.g. an unreachable
+    coordinator) are raised, the lease of a job expires as usual if its worker
+    cannot renew it in time.
+    '''
+
+    def __init__(self, url, token=None, lease_seconds=10*60, timeout=30):
+        self.url = url.rstrip("/")
+        self.token = token
+        # has to match the coordinator, renewals are scheduled by it
+        self.lease_seconds = lease_seconds
+        self.timeout = timeout
+
+    def call(self, method, **kwargs):
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+        response = requests.post(f"{self.url}/{method}", json=kwargs, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["result"]
+
+    def lease(self, worker):
+        return self.call("lease", worker=worker)
+
+    def renew(self, job_id, worker):
+        return self.call("renew", job_id=job_id, worker=worker)
+
+    def complete(self, job_id, worker, success, reason=None, phases=None):
+        return self.call("complete", job_id=job_id, worker=worker, success=success, reason=reason, phases=phases)
+
+
+def is_remote(location):
+    return location.startswith(("http://", "https://"))
+
+def open_job_queue(location):
+    # a path opens the sqlite database (same host), a url the api of a coordinator
+    if is_remote(location):
+        return RemoteJobQueue(location, os.environ.get(ENV_JOB_QUEUE_TOKEN))
+    return JobQueue(location)
+
+def serve_job_queue(job_queue, listen):
+    host, port = listen.rsplit(":", 1)
+    server = JobQueueServer(job_queue, (host, int(port)), os.environ.get(ENV_JOB_QUEUE_TOKEN))
+    threading.Thread(target=server.serve_forever, name="job-queue-server", daemon=True).start()
+    logger.info(f"serving job queue on {listen}")
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='print the jobs per provider and status')
+    parser.add_argument('--path', default=PATH_JOB_QUEUE)
+    args = parser.parse_args()
+
+    conn = JobQueue(args.path).connect()
+    query = "SELECT provider, status, COUNT(*), SUM(success), AVG(finished - leased) FROM jobs GROUP BY provider, status ORDER BY provider, status"
+    print(f"{'provider':<20} {'status':<10} {'jobs':>8} {'successful':>10} {'avg[s]':>8}")
+    for provider, status, count, successes, seconds in conn.execute(query):
+        print(f"{str(provider):<20} {status:<10} {count:>8} {successes or 0:>10} {f'{seconds:.1f}' if seconds else '-':>8}")
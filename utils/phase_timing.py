@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import json
+import math
+import time
+import argparse
+import functools
+import threading
+from contextlib import contextmanager
+
+PATH_PHASE_TIMES = "phase_times.jsonl"
+
+phase_times_lock = threading.Lock()
+# phases of the iteration the current thread is working on
+active = threading.local()
+
+
+@contextmanager
+def collect_phases(phases, outcomes=None):
+    # phases: dict of phase -> list of seconds, filled by all timed phases of this thread
+    # outcomes (optional): dict of phase -> list of "ok" or the exception class name, in the order of the seconds
+    previous = get_active_phases(), get_active_outcomes()
+    active.phases, active.outcomes = phases, outcomes
+    try:
+        yield phases
+    finally:
+        active.phases, active.outcomes = previous
+
+def get_active_phases():
+    return getattr(active, "phases", None)
+
+def get_active_outcomes():
+    return getattr(active, "outcomes", None)
+
+def add_phase_time(phase, seconds, outcome="ok"):
+    phases = get_active_phases()
+    if phases is not None:
+        phases.setdefault(phase, []).append(round(seconds, 3))
+        outcomes = get_active_outcomes()
+        if outcomes is not None:
+            outcomes.setdefault(phase, []).append(outcome)
+
+def timed_phase(phase):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            time_start = time.time()
+            outcome = "ok"
+            try:
+                return func(*args, **kwargs)
+            except BaseException as e:
+                outcome = type(e).__name__
+                raise
+            finally:
+                add_phase_time(phase, time.time() - time_start, outcome)
+        return wrapper
+    return decorator
+
+def record_phase_times(record, path=PATH_PHASE_TIMES):
+    with phase_times_lock:
+        with open(path, "a") as file:
+            file.write(json.dumps(record) + "\n")
+
+def read_phase_times(path=PATH_PHASE_TIMES):
+    records = []
+    try:
+        with open(path) as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except:
+                    pass
+    except FileNotFoundError:
+        pass
+    return records
+
+def percentile(values, p):
+    # nearest-rank percentile of a sorted list
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def print_summary(records, group_by=("provider",)):
+    groups = dict()
+    errors = dict()
+    for r in records:
+        key = tuple(r.get(k) for k in group_by)
+        for phase, seconds in r.get('phases', {}).items():
+            groups.setdefault((phase,) + key, []).extend(seconds)
+        # records written before outcomes were recorded count as ok
+        for phase, outcomes in r.get('outcomes', {}).items():
+            errors[(phase,) + key] = errors.get((phase,) + key, 0) + sum(o != "ok" for o in outcomes)
+    print(f"{' / '.join(('phase',) + tuple(group_by)):<60} {'n':>6} {'errors':>6} {'p50[s]':>8} {'p90[s]':>8} {'p99[s]':>8}")
+    for key, seconds in sorted(groups.items(), key=lambda x: str(x[0])):
+        seconds = sorted(seconds)
+        print(f"{' / '.join(str(k) for k in key):<60} {len(seconds):>6} {errors.get(key, 0):>6} {percentile(seconds, 50):>8.1f} {percentile(seconds, 90):>8.1f} {percentile(seconds, 99):>8.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='print p50/p90/p99 of the iteration phases')
+    parser.add_argument('--path', default=PATH_PHASE_TIMES)
+    parser.add_argument('--group_by', default="provider")
+    args = parser.parse_args()
+    print_summary(read_phase_times(args.path), [k for k in args.group_by.split(",") if k])
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import queue
+import sqlite3
+import logging
+import argparse
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PATH_RESULTS_DB = "results.sqlite"
+RUN_METADATA_FILENAME = "run.json"
+# written into a run directory once its files are in the database, so the startup scan skips it
+INGESTED_MARKER_FILENAME = ".ingested"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    image TEXT,
+    container TEXT,
+    provider TEXT,
+    vpn_type TEXT,
+    country TEXT,
+    region TEXT,
+    endpoint TEXT,
+    gluetun_ip TEXT,
+    started REAL,
+    finished REAL,
+    exit_code INTEGER,
+    metadata TEXT,
+    session_id TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    run_id TEXT,
+    path TEXT,
+    size INTEGER,
+    mtime REAL,
+    content BLOB,
+    PRIMARY KEY (run_id, path)
+);
+CREATE INDEX IF NOT EXISTS runs_provider_country ON runs (provider, country);
+CREATE INDEX IF NOT EXISTS runs_image ON runs (image);
+"""
+
+# columns added after the first release, databases created before get them via ALTER TABLE
+MIGRATIONS = [
+    ("runs", "session_id", "TEXT", "CREATE INDEX IF NOT EXISTS runs_session ON runs (session_id)"),
+]
+
+RUN_COLUMNS = ["run_id", "image", "container", "provider", "vpn_type", "country", "region", "endpoint",
+               "gluetun_ip", "started", "finished", "exit_code", "metadata", "session_id"]
+
+
+def write_run_metadata(run_dir, metadata):
+    tmp_path = Path(run_dir) / f"{RUN_METADATA_FILENAME}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(metadata, file, indent=4)
+    os.replace(tmp_path, Path(run_dir) / RUN_METADATA_FILENAME)
+
+def read_run_metadata(run_dir):
+    with open(Path(run_dir) / RUN_METADATA_FILENAME) as file:
+        return json.load(file)
+
+def connect(db_path=PATH_RESULTS_DB):
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    migrate(conn)
+    return conn
+
+def migrate(conn):
+    for table, column, column_type, index in MIGRATIONS:
+        if column not in [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]:
+            logger.info(f"add column {column} to table {table}")
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        conn.execute(index)
+    conn.commit()
+
+def is_ingested(conn, run_id):
+    return conn.execute("SELECT 1 FROM runs WHERE run_id = ?", (run_id,)).fetchone() is not None
+
+def mark_ingested(run_dir):
+    (Path(run_dir) / INGESTED_MARKER_FILENAME).touch()
+
+def ingest_run(conn, run_dir):
+    run_dir = Path(run_dir)
+    metadata = read_run_metadata(run_dir)
+    if is_ingested(conn, metadata['run_id']):
+        # e.g. ingested before the marker was written
+        mark_ingested(run_dir)
+        return 0
+    files = [p for p in sorted(run_dir.rglob("*")) if p.is_file() and p.name not in (RUN_METADATA_FILENAME, INGESTED_MARKER_FILENAME)]
+    with conn:
+        conn.execute(f"INSERT INTO runs ({', '.join(RUN_COLUMNS)}) VALUES ({', '.join('?' * len(RUN_COLUMNS))})", (
+            metadata['run_id'],
+            metadata.get('image'),
+            metadata.get('container'),
+            metadata.get('provider'),
+            metadata.get('vpn_type'),
+            metadata.get('country'),
+            metadata.get('region'),
+            metadata.get('endpoint'),
+            metadata.get('gluetun_ip'),
+            metadata.get('started'),
+            metadata.get('finished'),
+            metadata.get('exit_code'),
+            json.dumps(metadata),
+            metadata.get('session_id'),
+        ))
+        for path in files:
+            stat = path.stat()
+            conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                         (metadata['run_id'], str(path.relative_to(run_dir)), stat.st_size, stat.st_mtime, path.read_bytes()))
+    mark_ingested(run_dir)
+    return len(files)
+
+def find_finished_runs(results_roots):
+    # ingested runs carry the marker, so runs of earlier sessions are not read again at every start
+    for root in results_roots:
+        for metadata_path in Path(root).glob(f"*/{RUN_METADATA_FILENAME}"):
+            if (metadata_path.parent / INGESTED_MARKER_FILENAME).exists():
+                continue
+            try:
+                if read_run_metadata(metadata_path.parent).get('finished'):
+                    yield metadata_path.parent
+            except:
+                logger.error(f"cannot read {metadata_path}")
+
+def ingest_finished_runs(conn, results_roots):
+    count = 0
+    for run_dir in find_finished_runs(results_roots):
+        try:
+            if ingest_run(conn, run_dir):
+                count += 1
+        except:
+            logger.exception(f"error ingesting {run_dir}")
+    return count
+
+
+class ResultIngester():
+    '''Append the files of finished measurement runs to a single sqlite store.
+
+    The orchestrator submits every run directory as soon as the measurement
+    container exited; run directories that finished while no ingester was
+    running are picked up once at startup. Ingested run directories are marked
+    (INGESTED_MARKER_FILENAME) and skipped by later startups.
+    '''
+
+    def __init__(self, db_path=PATH_RESULTS_DB, results_roots=()):
+        self.db_path = db_path
+        self.results_roots = list(results_roots)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="result-ingester", daemon=True)
+        self.thread.start()
+
+    def submit(self, run_dir):
+        self.queue.put(run_dir)
+
+    def run(self):
+        # sqlite connections must stay in the thread that created them
+        conn = connect(self.db_path)
+        count = ingest_finished_runs(conn, self.results_roots)
+        if count:
+            logger.info(f"ingested {count} runs left over from previous sessions")
+        while True:
+            run_dir = self.queue.get()
+            try:
+                count = ingest_run(conn, run_dir)
+                logger.info(f"ingested {count} result files of {run_dir}")
+            except:
+                logger.exception(f"error ingesting {run_dir}")
+            self.queue.task_done()
+
+    def join(self):
+        self.queue.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ingest finished measurement runs into the results database')
+    parser.add_argument('--db', default=PATH_RESULTS_DB)
+    parser.add_argument('results_dirs', nargs='*', default=[str(p) for p in Path("docker").glob("*/results")])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    time_start = time.time()
+    count = ingest_finished_runs(connect(args.db), args.results_dirs)
+    logger.info(f"ingested {count} runs in {time.time() - time_start:.1f}s")
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+
+logger = logging.getLogger(__name__)
+
+PATH_WARP_PROFILES = "warp_profiles.json"
+PROFILE_KEYS = ["PublicKey", "PrivateKey", "Address", "MTU"]
+
+
+def parse_wgcf_profile(config):
+    # wireguard profile generated by wgcf, repeated keys (e.g. ipv4/ipv6 Address) are joined by comma
+    params = dict()
+    for line in config.splitlines():
+        if "=" in line:
+            key, value = [x.strip() for x in line.split("=", 1)]
+            if key in params:
+                params[key] = f"{params[key]},{value}"
+            else:
+                params[key] = value
+    return {k: params[k] for k in PROFILE_KEYS}
+
+
+class WarpProfilePool():
+    '''Pool of registered warp (wgcf) profiles, persisted to a json file.
+
+    register(via) is called to create a new profile (returns the wgcf profile
+    text), via is a connected vpn container whose network the registration
+    uses, so that the accounts are not created from the host address. A profile
+    is handed out to one owner at a time and retired after max_uses. Whenever
+    fewer than min_size unused profiles are left, the pool is refilled in a
+    background thread via the vpn container of the acquire; only an empty pool
+    registers synchronously.
+    '''
+
+    def __init__(self, register, path=PATH_WARP_PROFILES, min_size=3, max_uses=10):
+        self.register = register
+        self.path = path
+        self.min_size = min_size
+        self.max_uses = max_uses
+        self.lock = threading.Lock()
+        self.refilling = False
+        self.profiles = list()
+        self.owners = dict()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                self.profiles = [p for p in json.load(file).get('profiles', []) if p['uses'] < self.max_uses]
+            logger.info(f"loaded {len(self.profiles)} warp profiles from {self.path}")
+        except FileNotFoundError:
+            pass
+        except:
+            logger.error(f"error reading warp profiles {self.path}, starting with an empty pool")
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        # the profiles hold private keys, only readable by the owner
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as file:
+            # also if a tmp file of an earlier (crashed) save is left
+            os.fchmod(file.fileno(), 0o600)
+            json.dump({'profiles': self.profiles}, file)
+        os.replace(tmp_path, self.path)
+
+    def get_available(self):
+        in_use = [id(p) for p in self.owners.values()]
+        return [p for p in self.profiles if p['uses'] < self.max_uses and id(p) not in in_use]
+
+    def register_profile(self, via, owner=None):
+        profile = parse_wgcf_profile(self.register(via)) | {'uses': 0, 'created': time.time()}
+        with self.lock:
+            self.profiles.append(profile)
+            if owner is not None:
+                self.owners[owner] = profile
+            self.save()
+        return profile
+
+    def refill(self, via):
+        try:
+            while True:
+                with self.lock:
+                    if len(self.get_available()) >= self.min_size:
+                        break
+                self.register_profile(via)
+                logger.info("registered new warp profile")
+        except:
+            # e.g. the vpn container was stopped meanwhile, the next acquire refills again
+            logger.exception("error registering warp profile")
+        finally:
+            with self.lock:
+                self.refilling = False
+
+    def refill_async(self, via):
+        with self.lock:
+            if self.refilling or len(self.get_available()) >= self.min_size:
+                return
+            self.refilling = True
+        threading.Thread(target=self.refill, args=(via,), name="warp-profile-refill", daemon=True).start()
+
+    def acquire(self, owner, via):
+        with self.lock:
+            available = self.get_available()
+            profile = min(available, key=lambda p: p['uses']) if available else None
+            if profile:
+                self.owners[owner] = profile
+        if not profile:
+            logger.warning("warp profile pool is empty, register synchronously")
+            profile = self.register_profile(via, owner)
+        with self.lock:
+            profile['uses'] += 1
+            profile['last_used'] = time.time()
+            self.save()
+        self.refill_async(via)
+        return profile
+
+    def release(self, owner):
+        with self.lock:
+            profile = self.owners.pop(owner, None)
+            if profile and profile['uses'] >= self.max_uses:
+                self.profiles.remove(profile)
+                self.save()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='print the pooled warp profiles')
+    parser.add_argument('--path', default=PATH_WARP_PROFILES)
+    args = parser.parse_args()
+
+    try:
+        with open(args.path) as file:
+            profiles = json.load(file).get('profiles', [])
+    except FileNotFoundError:
+        profiles = []
+    for p in profiles:
+        print(f"{p['Address']:<70} uses {p['uses']:>4} created {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(p['created']))}")